@@ -1,21 +1,37 @@
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import datetime as dt
-import requests
-import json
 from web3 import Web3
 from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
 import pandas as pd
-from pycoingecko import CoinGeckoAPI
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.batch_provider import BatchHTTPProvider
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.decode import decode_logs
+from common.frames import build_frame
+from common.ledger import TransferLedger
+from common.log_cache import get_cached_logs
+from common.metrics import dump_metrics, metrics_middleware, report_metrics
+from common.multicall import multicall
+from common.prices import PriceService
+from common.ratelimit import rate_limit_middleware, report_waits
 
 
 load_dotenv()
 ALCHEMY_URL = os.environ['ALCHEMY_URL_ARB']
-W3  = Web3(Web3.HTTPProvider(ALCHEMY_URL))
-ETHERSCAN_API_KEY = os.environ['ARB_ETHERSCAN_API']
-CG = CoinGeckoAPI()
+W3 = Web3(BatchHTTPProvider(ALCHEMY_URL))
+W3.middleware_onion.add(metrics_middleware)   # inside the rate limiter: times requests, not waits
+W3.middleware_onion.add(rate_limit_middleware)
+PRICES = PriceService('arbitrum-one')
 FROM_BLOCK = 1   # pair factory creation block
+SNAP_DATE = dt.date(2023, 6, 1)
+LOG_WORKERS = 4       # pairs fetching their logs at once (each with get_logs' own threads)
+PAIR_WORKERS = 8      # pairs being replayed and read at once (their calls are batched by the provider)
+PAIR_LOOKAHEAD = 16   # pairs whose logs may be fetched or held before they're processed
 
 ERC20_ABI = [
     {
@@ -71,39 +87,59 @@ ERC20_ABI = [
     }]
 
 
-def get_coingecko_prices(token_set, time_stamp, blockchain):
-    ''' pulls CoinGecko data from set of addresses '''
-
-    # pull list of tokens that have data in CoinGecko
-    df = pd.DataFrame(columns=['api_id', 'symbol'])
-    df.index.name = 'token'
-    for token in token_set:
-        print(f'CG get info: {token}')
-        try:
-            token_data = CG.get_coin_info_from_contract_address_by_id(blockchain, token)
-            df.loc[token] = token_data['id'], token_data['symbol']
-        except ValueError as e:
-            if str(e) == "{'error': 'coin not found'}":
-                continue
-            else:
-                raise
-
-    # enrich with prices as of time_stamp:
-    date_str = dt.datetime.fromtimestamp(time_stamp, tz=dt.timezone.utc).strftime('%d-%m-%Y')
-    for token in df.index:
-        print(f'CG get info: {token}')
-        api_id = df.loc[token, 'api_id']
-        hist_data = CG.get_coin_history_by_id(api_id, date_str)
-        try:
-            price = hist_data['market_data']['current_price']['usd']
-        except:
-            if api_id == 'real-usd':
-                price = 1.0
-            else:
-                price = 0.0
-        df.loc[token, 'price'] = price
-
-    return df
+GAUGE_ABI = [
+    {
+        'inputs': [
+            {
+                'internalType': 'address',
+                'name': '_user',
+                'type': 'address'
+            }],
+        'name': 'balanceOf',
+        'outputs': [
+            {
+                'internalType': 'uint256',
+                'name': '',
+                'type': 'uint256'
+            }],
+        'stateMutability': 'view',
+        'type': 'function'
+    },
+    {
+        'inputs': [],
+        'name': 'totalSupply',
+        'outputs': [
+            {
+                'internalType': 'uint256',
+                'name': '',
+                'type': 'uint256'
+            }],
+        'stateMutability': 'view',
+        'type': 'function'},
+    {
+        'anonymous': False,
+        'inputs': [
+            {
+                'indexed': True,
+                'internalType': 'address',
+                'name': 'user',
+                'type': 'address'
+            },
+            {
+                'indexed': False,
+                'internalType': 'uint256',
+                'name': 'tokenId',
+                'type': 'uint256'
+            },
+            {
+                'indexed': False,
+                'internalType': 'uint256',
+                'name': 'amount',
+                'type': 'uint256'
+            }],
+        'name': 'Deposit',
+        'type': 'event'
+    }]
 
 
 def get_reserves(pair_set, block_num):
@@ -130,12 +166,14 @@ def get_reserves(pair_set, block_num):
                 }],
             'stateMutability': 'view',
             'type': 'function'}]
-    df = pd.DataFrame(columns=['reserve0', 'reserve1'])
-    df.index.name = 'pair'
-    for pair in pair_set:
-        contract = W3.eth.contract(pair, abi=abi)
-        reserve0, reserve1, _ = contract.functions.getReserves().call(block_identifier=block_num)
-        df.loc[pair, ['reserve0', 'reserve1']] = reserve0, reserve1
+    pair_list = list(pair_set)
+    calls = [W3.eth.contract(pair, abi=abi).functions.getReserves() for pair in pair_list]
+    reserves = multicall(W3, calls, block_num)
+    df = build_frame(pair_list,
+                     {'reserve0': [reserve0 for reserve0, _, _ in reserves],
+                      'reserve1': [reserve1 for _, reserve1, _ in reserves]},
+                     index_name='pair',
+                     dtypes={'reserve0': 'float64', 'reserve1': 'float64'})
 
     return df
 
@@ -154,12 +192,10 @@ def get_decimals(token_set, block_num):
                 }],
             'stateMutability': 'view',
             'type': 'function'}]
-    df = pd.DataFrame(columns=['decimals'])
-    df.index.name = 'token'
-    for token in token_set:
-        contract = W3.eth.contract(token, abi=abi)
-        decimals = contract.functions.decimals().call(block_identifier=block_num)
-        df.loc[token, 'decimals'] = decimals
+    token_list = list(token_set)
+    calls = [W3.eth.contract(token, abi=abi).functions.decimals() for token in token_list]
+    df = build_frame(token_list, {'decimals': multicall(W3, calls, block_num)},
+                     index_name='token', dtypes={'decimals': 'int64'})
 
     return df
 
@@ -214,17 +250,13 @@ def get_all_pairs(time_stamp, block_num):
         fromBlock=FROM_BLOCK,
         toBlock=block_num
     )
-    logs = W3.eth.get_logs(event_filter_params)
-    df = pd.DataFrame(columns=['token0', 'token1'])
-    df.index.name = 'pair'
-    for log in logs:
-        evt = get_event_data(W3.codec, pair_created_event_abi, log)
-        args = evt['args']
-        df.loc[args['pair']] = args['token0'], args['token1']
+    logs = get_cached_logs(W3, event_filter_params)
+    df_logs = decode_logs(W3, pair_created_event_abi, logs)
+    df = build_frame(df_logs.pair.values, {'token0': df_logs.token0.values, 'token1': df_logs.token1.values}, index_name='pair')
 
     # enrich with prices from CoinGecko (ignore anything that's unlisted there):
     token_set = set(df.token0).union(df.token1)
-    df_prices = get_coingecko_prices(token_set, time_stamp, 'arbitrum-one')
+    df_prices = PRICES.get_prices(token_set, time_stamp)
     df = df.join(df_prices[['price']], on='token0', how='inner').rename(columns={'price': 'price0'})
     df = df.join(df_prices[['price']], on='token1', how='inner').rename(columns={'price': 'price1'})
 
@@ -237,8 +269,8 @@ def get_all_pairs(time_stamp, block_num):
     df = df.join(df_decimals, on='token0').rename(columns={'decimals': 'decimals0'})
     df = df.join(df_decimals, on='token1').rename(columns={'decimals': 'decimals1'})
 
-    df.reserve0 /= 10 ** df.decimals0
-    df.reserve1 /= 10 ** df.decimals1
+    df.reserve0 /= 10.0 ** df.decimals0
+    df.reserve1 /= 10.0 ** df.decimals1
 
     df['TVL'] = df.price0 * df.reserve0 + df.price1 * df.reserve1
 
@@ -293,25 +325,18 @@ def get_all_gauges(block_num):
         fromBlock=FROM_BLOCK,
         toBlock=block_num
     )
-    logs = W3.eth.get_logs(event_filter_params)
+    logs = get_cached_logs(W3, event_filter_params)
 
     # get vault addresses:
-    df = pd.DataFrame(columns=['gauge'])
-    df.index.name = 'pool'
-    for log in logs:
-        evt = get_event_data(W3.codec, abi, log)
-        args = evt['args']
-        df.loc[args['pool']] = args['gauge']
+    df_logs = decode_logs(W3, abi, logs)
+    df = build_frame(df_logs.pool.values, {'gauge': df_logs.gauge.values}, index_name='pool')
 
     return df
 
 
-def get_erc20_owners(erc20, block_num):
-    ''' retrieve all owners of ERC20 token that emits transfer events '''
-    # pull all transfer events:
-    contract = W3.eth.contract(erc20, abi=ERC20_ABI)
-    transfer_event = contract.events.Transfer
-    transfer_event_abi = transfer_event._get_event_abi()
+def get_transfer_logs(erc20, block_num):
+    ''' all Transfer logs of an ERC20 token up to block_num '''
+    transfer_event_abi = W3.eth.contract(erc20, abi=ERC20_ABI).events.Transfer._get_event_abi()
     _, event_filter_params = construct_event_filter_params(
         transfer_event_abi,
         W3.codec,
@@ -320,89 +345,12 @@ def get_erc20_owners(erc20, block_num):
         fromBlock=FROM_BLOCK,
         toBlock=block_num
     )
-    logs = W3.eth.get_logs(event_filter_params)
-
-    # find list of all LPs that have ever been sent LP token:
-    owners = set()
-    for log in logs:
-        evt = get_event_data(W3.codec, transfer_event_abi, log)
-        owners.add(evt['args']['to'])
-
-    # get balances:
-    df = pd.DataFrame(columns=['balance'])
-    df.index.name = 'owner'
-    for owner in owners:
-        balance = contract.functions.balanceOf(owner).call(block_identifier=block_num)
-        df.loc[owner, 'balance'] = balance
+    return get_cached_logs(W3, event_filter_params)
 
-    # check to make sure we have the full total:
-    total_balance = contract.functions.totalSupply().call(block_identifier=block_num)
-    assert df.balance.sum() == total_balance
-    
-    df['pct_own'] = df.balance / df.balance.sum()
-    return df[['pct_own']]
-    #return df
 
-
-def get_gauge_users(gauge, block_num):
-    abi = [
-        {
-            'inputs': [
-                {
-                    'internalType': 'address',
-                    'name': '_user',
-                    'type': 'address'
-                }],
-            'name': 'balanceOf',
-            'outputs': [
-                {
-                    'internalType': 'uint256',
-                    'name': '',
-                    'type': 'uint256'
-                }],
-            'stateMutability': 'view',
-            'type': 'function'
-        },
-        {
-            'inputs': [],
-            'name': 'totalSupply',
-            'outputs': [
-                {
-                    'internalType': 'uint256',
-                    'name': '',
-                    'type': 'uint256'
-                }],
-            'stateMutability': 'view',
-            'type': 'function'},
-        {
-            'anonymous': False,
-            'inputs': [
-                {
-                    'indexed': True,
-                    'internalType': 'address',
-                    'name': 'user',
-                    'type': 'address'
-                },
-                {
-                    'indexed': False,
-                    'internalType': 'uint256',
-                    'name': 'tokenId',
-                    'type': 'uint256'
-                },
-                {
-                    'indexed': False,
-                    'internalType': 'uint256',
-                    'name': 'amount',
-                    'type': 'uint256'
-                }],
-            'name': 'Deposit',
-            'type': 'event'
-        }]
-
-    # pull all Deposit events:
-    contract = W3.eth.contract(gauge, abi=abi)
-    deposit_event = contract.events.Deposit
-    deposit_event_abi = deposit_event._get_event_abi()
+def get_deposit_logs(gauge, block_num):
+    ''' all Deposit logs of a gauge up to block_num '''
+    deposit_event_abi = W3.eth.contract(gauge, abi=GAUGE_ABI).events.Deposit._get_event_abi()
     _, event_filter_params = construct_event_filter_params(
         deposit_event_abi,
         W3.codec,
@@ -411,30 +359,58 @@ def get_gauge_users(gauge, block_num):
         fromBlock=FROM_BLOCK,
         toBlock=block_num
     )
-    logs = W3.eth.get_logs(event_filter_params)
+    return get_cached_logs(W3, event_filter_params)
 
-    # assemble sets of users and transactions:
-    users = set()
-    for log in logs:
-        evt = get_event_data(W3.codec, deposit_event_abi, log)
-        users.add(evt['args']['user'])
 
-    df = pd.DataFrame(columns=['balance'])
-    df.index.name = 'owner'
-    for user in users:
-        balance = contract.functions.balanceOf(user).call(block_identifier=block_num)
-        df.loc[user] = balance
+def get_erc20_owners(erc20, block_num, logs=None):
+    ''' retrieve all owners of ERC20 token that emits transfer events
+        (from its Transfer logs, pulled here unless given) '''
+    contract = W3.eth.contract(erc20, abi=ERC20_ABI)
+    transfer_event_abi = contract.events.Transfer._get_event_abi()
+    if logs is None:
+        logs = get_transfer_logs(erc20, block_num)
+
+    # replay transfers into balances of everyone that has ever held the LP token:
+    ledger = TransferLedger()
+    ledger.add_table(decode_logs(W3, transfer_event_abi, logs))
+    balances, ledger_supply = ledger.replay(block_num)
+
+    # check to make sure we have the full total:
+    total_balance = contract.functions.totalSupply().call(block_identifier=block_num)
+    assert ledger_supply == total_balance
+    assert sum(balances.values()) == total_balance
+
+    # exact integer division per owner, then one float column:
+    owners = list(balances)
+    pct_own = [balances[owner] / total_balance for owner in owners] if total_balance > 0 else float('nan')
+    df = build_frame(owners, {'pct_own': pct_own}, index_name='owner', dtypes={'pct_own': 'float64'})
+    return df
+
+
+def get_gauge_users(gauge, block_num, logs=None):
+    # Deposit events (pulled here unless given):
+    contract = W3.eth.contract(gauge, abi=GAUGE_ABI)
+    deposit_event_abi = contract.events.Deposit._get_event_abi()
+    if logs is None:
+        logs = get_deposit_logs(gauge, block_num)
+
+    # assemble sets of users and transactions:
+    users = list(set(decode_logs(W3, deposit_event_abi, logs).user))
+    calls = [contract.functions.balanceOf(user) for user in users]
+    balances = multicall(W3, calls, block_num)
 
     # for some reason there's a bit of dust in some of these, so doesn't perfectly line-up:
     total_balance = contract.functions.totalSupply().call(block_identifier=block_num)
-    balance_sum = df.balance.astype('float').sum()
-    if total_balance > 0 or df.balance.sum() > 0:
+    balance_sum = float(sum(balances))
+    if total_balance > 0 or balance_sum > 0:
         if abs(balance_sum / total_balance - 1) > 1e-3:
             print(f'warning: df.balance.sum() = {balance_sum}, total_balance = {total_balance}')
-        df['pct_own'] = df.balance / total_balance
+        pct_own = [balance / total_balance for balance in balances]
     else:
-        df['pct_own'] = 1.0
+        pct_own = 1.0
 
+    df = build_frame(users, {'balance': balances, 'pct_own': pct_own}, index_name='owner',
+                     dtypes={'balance': 'float64', 'pct_own': 'float64'})
     return df
 
 
@@ -455,18 +431,25 @@ def get_pair_name(pair):
     return contract.functions.name().call()
 
 
-def get_all_lps(pair, gauge, block_num):
+def get_pair_logs(pair, gauge, block_num):
+    ''' (Transfer logs of the pair, Deposit logs of its gauge or None) '''
+    deposit_logs = None if pd.isnull(gauge) else get_deposit_logs(gauge, block_num)
+    return get_transfer_logs(pair, block_num), deposit_logs
+
+
+def get_all_lps(pair, gauge, block_num, pair_logs=None):
     ''' for a given Pair returns all LP addresses and percent ownership
-        (takes into account gauges) '''
+        (takes into account gauges); pair_logs as returned by get_pair_logs '''
+    transfer_logs, deposit_logs = pair_logs or (None, None)
 
     # pull free LPs:
-    df_pair_lps = get_erc20_owners(pair, block_num)
+    df_pair_lps = get_erc20_owners(pair, block_num, transfer_logs)
     df_pair_lps['type'] = 'LP'
 
     # pull LPs from gauge:
     if not pd.isnull(gauge) and gauge in df_pair_lps.index:
         gauge_pct_own = df_pair_lps.loc[gauge, 'pct_own']
-        df_gauge_lps = get_gauge_users(gauge, block_num)
+        df_gauge_lps = get_gauge_users(gauge, block_num, deposit_logs)
         df_gauge_lps['type'] = 'GaugeLP'
         df_gauge_lps.pct_own *= gauge_pct_own
         df_pair_lps.drop(gauge, inplace=True)
@@ -479,31 +462,49 @@ def get_all_lps(pair, gauge, block_num):
     return df_pair_lps
 
 
-if __name__ == '__main__':
-    # get block time from time_stamp:
-    time_stamp = int(dt.datetime(2023, 6, 1).replace(tzinfo=dt.timezone.utc).timestamp())
-    response = requests.get('https://api.arbiscan.io/api',
-                            params={'module': 'block',
-                                    'action': 'getblocknobytime',
-                                    'timestamp': time_stamp,
-                                    'closest': 'before',
-                                    'apikey': ETHERSCAN_API_KEY})
-    response_json = json.loads(response.content)
-    block_num = int(response_json['result'])
+def run(snap_date):
+    ''' LP balances (USD) per owner across all Chronos pairs as of snap_date '''
+    # get snapshot block from time_stamp:
+    time_stamp = date_to_timestamp(snap_date)
+    block_num = get_block_by_timestamp(W3, time_stamp)
 
     df_pairs = get_all_pairs(time_stamp, block_num)
     df_gauges = get_all_gauges(block_num)
     df_pairs = df_pairs.join(df_gauges)
 
-    # find ownership:
-    df_lps_list = []
-    for pair, row in df_pairs.iterrows():
-        print(pair)
-        df_lps = get_all_lps(pair, row.gauge, block_num)
-        df_lps['TVL'] = row.TVL
-        df_lps_list.append(df_lps)
+    # find ownership, pairs side by side: logs are fetched up to PAIR_LOOKAHEAD pairs
+    # ahead while earlier pairs are replayed and their balances read
+    lookahead = threading.Semaphore(PAIR_LOOKAHEAD)
 
-    df_lps_all = pd.concat(df_lps_list)
+    def get_pair_frame(pair, gauge, tvl, logs_future):
+        try:
+            df_lps = get_all_lps(pair, gauge, block_num, logs_future.result())
+        finally:
+            lookahead.release()
+        df_lps['TVL'] = tvl
+        return df_lps
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=LOG_WORKERS) as fetchers, \
+            ThreadPoolExecutor(max_workers=PAIR_WORKERS) as workers:
+        for pair, row in df_pairs.iterrows():
+            lookahead.acquire()
+            logs_future = fetchers.submit(get_pair_logs, pair, row.gauge, block_num)
+            futures.append(workers.submit(get_pair_frame, pair, row.gauge, row.TVL, logs_future))
+
+    # concatenated in df_pairs order, same as one pair at a time:
+    df_lps_all = pd.concat([future.result() for future in futures])
     df_lps_all['balance'] = df_lps_all.pct_own * df_lps_all.TVL
     df_lps_all.sort_values('balance', ascending=False, inplace=True)
-    df_lps_all.groupby('owner')[['balance']].sum().to_csv('chronos_data.csv')
+    return df_lps_all.groupby('owner')[['balance']].sum()
+
+
+def main():
+    run(SNAP_DATE).to_csv('chronos_data.csv')
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('chronos_metrics.json')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,36 @@
 import os
+import sys
 from dotenv import load_dotenv
 import datetime as dt
-import requests
-import json
 from web3 import Web3
 from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from pycoingecko import CoinGeckoAPI
-import re
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.batch_provider import BatchHTTPProvider, batch_map
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.decode import decode_logs
+from common.frames import build_frame
+from common.log_cache import get_cached_logs
+from common.metrics import dump_metrics, metrics_middleware, report_metrics
+from common.multicall import multicall
+from common.ratelimit import rate_limit_middleware, report_waits
+from common.stakes import get_stakes
 
 
 load_dotenv()
-ETHERSCAN_API_KEY = os.environ['ETHERSCAN_API']
 ALCHEMY_URL = os.environ['ALCHEMY_URL_ETH']
-W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL))
+W3 = Web3(BatchHTTPProvider(ALCHEMY_URL))
+W3.middleware_onion.add(metrics_middleware)   # inside the rate limiter: times requests, not waits
+W3.middleware_onion.add(rate_limit_middleware)
 CG = CoinGeckoAPI()
 FROM_BLOCK = 1
+SNAP_DATE = dt.date(2023, 6, 1)
+POOL_WORKERS = 4   # pools processed at once, each with batch_map's threads
+REPLAY_BALANCES = False   # use the replayed stakes instead of balanceOf/totalSupply calls
 
 BOOSTER_ABI = [
     {
@@ -99,7 +112,37 @@ REWARD_POOL_ABI = [
                 'name': '',
                 'type': 'uint256'}],
         'stateMutability': 'view',
-        'type': 'function'}]
+        'type': 'function'},
+    {
+        'anonymous': False,
+        'inputs': [
+            {
+                'indexed': True,
+                'internalType': 'address',
+                'name': 'user',
+                'type': 'address'},
+            {
+                'indexed': False,
+                'internalType': 'uint256',
+                'name': 'amount',
+                'type': 'uint256'}],
+        'name': 'Staked',
+        'type': 'event'},
+    {
+        'anonymous': False,
+        'inputs': [
+            {
+                'indexed': True,
+                'internalType': 'address',
+                'name': 'user',
+                'type': 'address'},
+            {
+                'indexed': False,
+                'internalType': 'uint256',
+                'name': 'amount',
+                'type': 'uint256'}],
+        'name': 'Withdrawn',
+        'type': 'event'}]
 
 
 
@@ -109,61 +152,51 @@ def get_convex_deposits(block_num):
     deposited_event = booster_contract.events.Deposited
     deposited_event_abi = deposited_event._get_event_abi()
 
-    logs_all = []
-    start_block = FROM_BLOCK
-    end_block = block_num
-    while True:
-        try:
-            print(f'trying block {start_block} to {end_block}...')
-            _, event_filter_params = construct_event_filter_params(
-                deposited_event_abi,
-                W3.codec,
-                address=booster,
-                argument_filters={'address': booster},
-                fromBlock=start_block,
-                toBlock=end_block
-            )
-            logs = W3.eth.get_logs(event_filter_params)
-        except ValueError as e:
-            print('failed...')
-            m = re.search('range should work: \[(0x[0-9a-f]*), (0x[0-9a-f]*)\]', str(e))
-            end_block = int(m.group(2), 0)
-            continue
-        logs_all.extend(logs)
-        if end_block == block_num:
-            break
-        start_block = end_block
-        end_block = block_num
-    print('done pulling logs.')
-
+    _, event_filter_params = construct_event_filter_params(
+        deposited_event_abi,
+        W3.codec,
+        address=booster,
+        argument_filters={'address': booster},
+        fromBlock=FROM_BLOCK,
+        toBlock=block_num
+    )
+    logs_all = get_cached_logs(W3, event_filter_params)
+
+    df = decode_logs(W3, deposited_event_abi, logs_all)
     pool_id_to_users = defaultdict(set)
-    for log in logs_all:
-        evt = get_event_data(W3.codec, deposited_event_abi, log)
-        args = evt['args']
-        pool_id_to_users[args['poolid']].add(args['user'])
+    for pool_id, users in df.groupby('poolid')['user']:
+        pool_id_to_users[pool_id] = set(users)
 
     return pool_id_to_users
 
 
-def get_token_info(pool_id, block_num):
-    ''' get LP token and reward pool '''
+def get_token_info(pool_ids, block_num):
+    ''' {pool_id: (lp_token, reward_pool)}, all poolInfo reads in Multicall3 batches '''
     booster = '0xF403C135812408BFbE8713b5A23a04b3D48AAE31'
     booster_contract = W3.eth.contract(booster, abi=BOOSTER_ABI)
-    pool_info = booster_contract.functions.poolInfo(pool_id).call(block_identifier=block_num)
-    lp_token = pool_info[0]
-    reward_pool = pool_info[3]
-    return lp_token, reward_pool
+    pool_infos = multicall(W3, [booster_contract.functions.poolInfo(pool_id) for pool_id in pool_ids], block_num)
+    return {pool_id: (pool_info[0], pool_info[3]) for pool_id, pool_info in zip(pool_ids, pool_infos)}
 
 
 def get_pool_ownership(reward_pool, users, block_num):
     ''' from reward pool get balance and total supply: '''
     reward_pool_contract = W3.eth.contract(reward_pool, abi=REWARD_POOL_ABI)
-    total_supply = reward_pool_contract.functions.totalSupply().call(block_identifier=block_num)
-    df_lp_ownership = pd.DataFrame(columns=['pct_own'], index=list(users))
+    # replay Staked/Withdrawn so users who have fully withdrawn are dropped before any call:
+    stakes = get_stakes(W3, reward_pool_contract, block_num, FROM_BLOCK)
+    users = [user for user in users if stakes.get(user, 0) > 0]
+    if REPLAY_BALANCES:
+        total_supply = sum(stakes.values())
+    else:
+        total_supply = reward_pool_contract.functions.totalSupply().call(block_identifier=block_num)
     if total_supply > 0:
-        for user in users:
-            user_balance = reward_pool_contract.functions.balanceOf(user).call(block_identifier=block_num)
-            df_lp_ownership.loc[user, 'pct_own'] = user_balance / total_supply
+        if REPLAY_BALANCES:
+            balances = [stakes[user] for user in users]
+        else:
+            balances = batch_map(lambda user: reward_pool_contract.functions.balanceOf(user).call(block_identifier=block_num), users)
+        pct_own = [user_balance / total_supply for user_balance in balances]
+    else:
+        pct_own = float('nan')
+    df_lp_ownership = build_frame(users, {'pct_own': pct_own}, index_name='user', dtypes={'pct_own': 'float64'})
     return df_lp_ownership
 
 
@@ -185,28 +218,36 @@ def get_decimals(token, block_num):
     return decimals
 
 
-def main():
+def run(snap_date):
+    ''' Convex pool ownership per user as of snap_date '''
     # get block number:
-    time_stamp = int(dt.datetime(2023, 6, 1).replace(tzinfo=dt.timezone.utc).timestamp())
-    response = requests.get('https://api.etherscan.io/api',
-                            params={'module': 'block',
-                                    'action': 'getblocknobytime',
-                                    'timestamp': time_stamp,
-                                    'closest': 'before',
-                                    'apikey': ETHERSCAN_API_KEY})
-    response_json = json.loads(response.content)
-    block_num = int(response_json['result'])
+    time_stamp = date_to_timestamp(snap_date)
+    block_num = get_block_by_timestamp(W3, time_stamp)
 
     # get Convex deposits:
     pool_id_to_users = get_convex_deposits(block_num)
-    df_pool_ownership_list = []
-    for pool_id in pool_id_to_users:
-        print(pool_id)
-        lp_token, reward_pool = get_token_info(pool_id, block_num)
+    token_info = get_token_info(list(pool_id_to_users), block_num)
+
+    def get_pool_frame(pool_id):
+        lp_token, reward_pool = token_info[pool_id]
         df_pool_ownership = get_pool_ownership(reward_pool, pool_id_to_users[pool_id], block_num)
         df_pool_ownership['crv_pool'] = lp_token
         df_pool_ownership['convex_pool_id'] = pool_id
-        df_pool_ownership_list.append(df_pool_ownership)
+        return df_pool_ownership
+
+    # pools run side by side (each one's balanceOf calls are batched by the provider):
+    with ThreadPoolExecutor(max_workers=POOL_WORKERS) as executor:
+        df_pool_ownership_list = list(executor.map(get_pool_frame, pool_id_to_users))
+
+    return pd.concat(df_pool_ownership_list)
+
+
+def main():
+    run(SNAP_DATE).to_clipboard()
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('convex_ethereum_metrics.json')
+
 
-    df_pool_ownership_all = pd.concat(df_pool_ownership_list)
-    df_pool_ownership_all.to_clipboard()
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,35 @@
 import os
+import sys
 from dotenv import load_dotenv
 import datetime as dt
-import requests
-import json
 from web3 import Web3
 from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
+from web3.middleware import geth_poa_middleware
 from collections import defaultdict
 import pandas as pd
 from pycoingecko import CoinGeckoAPI
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.batch_provider import BatchHTTPProvider, batch_map
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.decode import decode_logs
+from common.frames import build_frame
+from common.log_cache import get_cached_logs
+from common.metrics import dump_metrics, metrics_middleware, report_metrics
+from common.ratelimit import rate_limit_middleware, report_waits
+from common.stakes import get_token_stakes
+
 
 load_dotenv()
-ETHERSCAN_API_KEY = os.environ['POLY_ETHERSCAN_API']
 ALCHEMY_URL = os.environ['ALCHEMY_URL_POLY']
-W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL))
+W3 = Web3(BatchHTTPProvider(ALCHEMY_URL))
+W3.middleware_onion.inject(geth_poa_middleware, layer=0)   # Polygon headers have long extraData
+W3.middleware_onion.add(metrics_middleware)   # inside the rate limiter: times requests, not waits
+W3.middleware_onion.add(rate_limit_middleware)
 CG = CoinGeckoAPI()
 FROM_BLOCK = 1
+SNAP_DATE = dt.date(2023, 6, 1)
+REPLAY_BALANCES = False   # use the replayed stakes instead of balanceOf/totalSupply calls
 
 BOOSTER_ABI = [
     {
@@ -94,7 +107,27 @@ REWARD_POOL_ABI = [
                 'name': '',
                 'type': 'uint256'}],
         'stateMutability': 'view',
-        'type': 'function'}]
+        'type': 'function'},
+    {
+        'anonymous': False,
+        'inputs': [
+            {
+                'indexed': True,
+                'internalType': 'address',
+                'name': 'from',
+                'type': 'address'},
+            {
+                'indexed': True,
+                'internalType': 'address',
+                'name': 'to',
+                'type': 'address'},
+            {
+                'indexed': False,
+                'internalType': 'uint256',
+                'name': 'value',
+                'type': 'uint256'}],
+        'name': 'Transfer',
+        'type': 'event'}]
 
 
 def get_convex_deposits(block_num):
@@ -111,13 +144,12 @@ def get_convex_deposits(block_num):
         fromBlock=FROM_BLOCK,
         toBlock=block_num
     )
-    logs = W3.eth.get_logs(event_filter_params)
+    logs = get_cached_logs(W3, event_filter_params)
 
+    df = decode_logs(W3, deposited_event_abi, logs)
     pool_id_to_users = defaultdict(set)
-    for log in logs:
-        evt = get_event_data(W3.codec, deposited_event_abi, log)
-        args = evt['args']
-        pool_id_to_users[args['poolid']].add(args['user'])
+    for pool_id, users in df.groupby('poolid')['user']:
+        pool_id_to_users[pool_id] = set(users)
 
     return pool_id_to_users
 
@@ -135,11 +167,17 @@ def get_token_info(pool_id, block_num):
 def get_pool_ownership(reward_pool, users, block_num):
     # from reward pool get balance and total supply:
     reward_pool_contract = W3.eth.contract(reward_pool, abi=REWARD_POOL_ABI)
-    total_supply = reward_pool_contract.functions.totalSupply().call(block_identifier=block_num)
-    df_lp_ownership = pd.DataFrame(columns=['pct_own'], index=list(users))
-    for user in users:
-        user_balance = reward_pool_contract.functions.balanceOf(user).call(block_identifier=block_num)
-        df_lp_ownership.loc[user, 'pct_own'] = user_balance / total_supply
+    # the reward pool is a token: replay its Transfers so users holding none are dropped before any call:
+    stakes = get_token_stakes(W3, reward_pool_contract, block_num, FROM_BLOCK)
+    users = [user for user in users if stakes.get(user, 0) > 0]
+    if REPLAY_BALANCES:
+        total_supply = sum(stakes.values())
+        balances = [stakes[user] for user in users]
+    else:
+        total_supply = reward_pool_contract.functions.totalSupply().call(block_identifier=block_num)
+        balances = batch_map(lambda user: reward_pool_contract.functions.balanceOf(user).call(block_identifier=block_num), users)
+    pct_own = [user_balance / total_supply for user_balance in balances]
+    df_lp_ownership = build_frame(users, {'pct_own': pct_own}, index_name='user', dtypes={'pct_own': 'float64'})
     return df_lp_ownership
 
 
@@ -162,28 +200,32 @@ def get_decimals(token, block_num):
     return decimals
 
 
-def main():
+def run(snap_date):
+    ''' Convex pool ownership per user as of snap_date '''
     # get block number:
-    time_stamp = int(dt.datetime(2023, 6, 1).replace(tzinfo=dt.timezone.utc).timestamp())
-    response = requests.get('https://api.polygonscan.com/api',
-                            params={'module': 'block',
-                                    'action': 'getblocknobytime',
-                                    'timestamp': time_stamp,
-                                    'closest': 'before',
-                                    'apikey': ETHERSCAN_API_KEY})
-    response_json = json.loads(response.content)
-    block_num = int(response_json['result'])
+    time_stamp = date_to_timestamp(snap_date)
+    block_num = get_block_by_timestamp(W3, time_stamp)
 
     # get Convex deposits:
     pool_id_to_users = get_convex_deposits(block_num)
 
     df_pool_ownership_list = []
     for pool_id in pool_id_to_users:
-        print(pool_id)
         lp_token, reward_pool = get_token_info(pool_id, block_num)
         df_pool_ownership = get_pool_ownership(reward_pool, pool_id_to_users[pool_id], block_num)
         df_pool_ownership['crv_pool'] = lp_token
         df_pool_ownership['convex_pool_id'] = pool_id
         df_pool_ownership_list.append(df_pool_ownership)
 
-    df_pool_ownership_all = pd.concat(df_pool_ownership_list)
+    return pd.concat(df_pool_ownership_list)
+
+
+def main():
+    run(SNAP_DATE)
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('convex_polygon_metrics.json')
+
+
+if __name__ == '__main__':
+    main()
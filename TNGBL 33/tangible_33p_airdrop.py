@@ -1,54 +1,38 @@
 import os
-import requests
 import json
 import pandas as pd
 from web3 import Web3
 from web3.middleware import geth_poa_middleware
 from dotenv import load_dotenv
-from ratelimiter import RateLimiter
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.http import get_session
+from common.journal import Journal
+from common.metrics import dump_metrics, metrics_middleware, report_metrics
+from common.multicall import multicall
+from common.ratelimit import rate_limit_middleware, rate_limited_get, report_waits
 
 # Load environment variables
 load_dotenv()
 API_KEY = os.getenv('COVALENT_API_KEY')
+RPC_URL = os.getenv('POLYGON_RPC_URL', 'https://polygon-rpc.com')
 
-# Define file names
+# Define file names (for snapshots at other blocks the block number is added to each name)
 holders_filename = 'holders.json'
 airdrop_filename = 'airdrop_data.json'
-intermediary_filename = 'intermediary_data.json'
-
-# Check if holders data exists
-if os.path.exists(holders_filename):
-    # Load holders data from file
-    with open(holders_filename, 'r') as file:
-        holders = json.load(file)
-    print(f"Loaded holders data from {holders_filename}")
-else:
-    # Fetch holders data from Covalent API
-    holders = []
-    page_number = 0
-    while True:
-        response = requests.get(
-            'https://api.covalenthq.com/v1/137/tokens/0xDc7ee66c43f35aC8C1d12Df90e61f05fbc2cd2c1/token_holders/',
-            params={
-                'block-height': 43386770,
-                'page-number': page_number,
-                'format': 'JSON',
-                'key': API_KEY
-            }
-        )
-        data = response.json()
-        holders.extend(data['data']['items'])
-        if not data['data']['pagination']['has_more']:
-            break
-        page_number += 1
-    # Save holders data to file
-    with open(holders_filename, 'w') as file:
-        json.dump(holders, file)
-    print(f"Saved holders data to {holders_filename}")
+intermediary_filename = 'intermediary_data.jsonl'
+
+snapshot_block = 43386770
+holders_per_segment = 1000  # holders per intermediary save
+multicall_workers = 4  # concurrent Multicall3 requests (still within the shared polygon-rpc.com budget)
 
 # Connect to Polygon Network
-w3 = Web3(Web3.HTTPProvider('https://polygon-rpc.com'))
+w3 = Web3(Web3.HTTPProvider(RPC_URL, session=get_session()))
 w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+w3.middleware_onion.add(metrics_middleware)   # inside the rate limiter: times requests, not waits
+w3.middleware_onion.add(rate_limit_middleware)  # 5 requests per second, shared by all threads
 
 # ABI for NFT contract
 ABI = [
@@ -122,58 +106,138 @@ addresses_to_exclude = [
 # Convert to checksum addresses
 addresses_to_exclude = [w3.to_checksum_address(address) for address in addresses_to_exclude]
 
-# Check if intermediary data exists
-if os.path.exists(intermediary_filename):
-    # Load intermediary data from file
-    with open(intermediary_filename, 'r') as file:
-        airdrop_data, totalValue, start_index = json.load(file)
-    print(f"Loaded intermediary data from {intermediary_filename}")
-else:
-    # Initialize intermediary data
-    airdrop_data = []
-    totalValue = 0
-    start_index = 0
-
-# Fetch airdrop data from blockchain
-rate_limiter = RateLimiter(max_calls=5, period=1)  # 5 requests per second
-for i, holder in enumerate(holders[start_index:], start=start_index):
-    print(i)
-    address = w3.to_checksum_address(holder['address'])
-    if address not in addresses_to_exclude:
-        with rate_limiter:
-            balance = contract.functions.balanceOf(address).call(block_identifier=43386770)
-            for index in range(balance):
-                tokenId = contract.functions.tokenOfOwnerByIndex(address, index).call(block_identifier=43386770)
-                lock = contract.functions.locks(tokenId).call(block_identifier=43386770)
-                value = lock[2] + lock[5]  # lockedAmount + maxPayout
-                totalValue += value
-                airdrop_data.append((address, value))
-            if i % 10 == 0:
-                # Save intermediary data to file
-                with open(intermediary_filename, 'w') as file:
-                    json.dump((airdrop_data, totalValue, i), file)
-                print(f"Processed {i} holders out of {len(holders)}. Intermediary data saved to {intermediary_filename}")
-
-# Save final airdrop data to file
-with open(airdrop_filename, 'w') as file:
-    json.dump(airdrop_data, file)
-print(f"Saved airdrop data to {airdrop_filename}")
-
-# Calculate airdrop amounts
-airdrop_amounts = [(address, value * 5000000000000000000000000 // totalValue) for address, value in airdrop_data]
-
-# Group by address
-address_to_amount = {}
-for address, amount in airdrop_amounts:
-    if address in address_to_amount:
-        address_to_amount[address] += amount
-    else:
-        address_to_amount[address] = amount
-
-# Sort by amount and write to CSV
-dataframe = pd.DataFrame(address_to_amount.items(), columns=['ADDRESS', 'AMOUNT'])
-dataframe['CHAIN'] = 'polygon'
-dataframe = dataframe[['CHAIN', 'ADDRESS', 'AMOUNT']]
-dataframe.sort_values(by='AMOUNT', ascending=False, inplace=True)
-dataframe.to_csv('33.csv', index=False)
-print('Saved airdrop amounts to 33.csv')
+
+def block_filename(filename, block):
+    """File name for data of a snapshot at block (the default snapshot keeps the plain name)"""
+    if block == snapshot_block:
+        return filename
+    name, extension = os.path.splitext(filename)
+    return f"{name}_{block}{extension}"
+
+
+def get_holders(block):
+    """All token holders at block, from Covalent or the local holders file"""
+    filename = block_filename(holders_filename, block)
+    # Check if holders data exists
+    if os.path.exists(filename):
+        # Load holders data from file
+        with open(filename, 'r') as file:
+            holders = json.load(file)
+        print(f"Loaded holders data from {filename}")
+        return holders
+
+    # Fetch holders data from Covalent API
+    holders = []
+    page_number = 0
+    while True:
+        response = rate_limited_get(
+            'https://api.covalenthq.com/v1/137/tokens/0xDc7ee66c43f35aC8C1d12Df90e61f05fbc2cd2c1/token_holders/',
+            params={
+                'block-height': block,
+                'page-number': page_number,
+                'format': 'JSON',
+                'key': API_KEY
+            }
+        )
+        data = response.json()
+        holders.extend(data['data']['items'])
+        if not data['data']['pagination']['has_more']:
+            break
+        page_number += 1
+    # Save holders data to file
+    with open(filename, 'w') as file:
+        json.dump(holders, file)
+    print(f"Saved holders data to {filename}")
+    return holders
+
+
+def get_airdrop_data(holders, block):
+    """(address, lockedAmount + maxPayout) for every lock of every holder at block"""
+    filename = block_filename(intermediary_filename, block)
+
+    # Rebuild intermediary data by replaying the journal (empty if this is a fresh run)
+    journal = Journal(filename)
+    airdrop_data = [tuple(record) for record in journal.records]
+    start_index = journal.progress or 0
+    if journal.progress is not None:
+        print(f"Loaded intermediary data from {filename}, resuming at holder {start_index}")
+
+    # Fetch airdrop data from blockchain, a segment of holders at a time:
+    # all balances, then all (owner, index) pairs, then all locks, each phase packed into Multicall3 calls
+    for segment_start in range(start_index, len(holders), holders_per_segment):
+        segment_end = min(segment_start + holders_per_segment, len(holders))
+        addresses = [w3.to_checksum_address(holder['address']) for holder in holders[segment_start:segment_end]]
+        addresses = [address for address in addresses if address not in addresses_to_exclude]
+
+        balances = multicall(w3, [contract.functions.balanceOf(address) for address in addresses], block,
+                             max_workers=multicall_workers)
+        owner_indexes = [(address, index) for address, balance in zip(addresses, balances) for index in range(balance)]
+        token_ids = multicall(w3, [contract.functions.tokenOfOwnerByIndex(address, index) for address, index in owner_indexes],
+                              block, max_workers=multicall_workers)
+        locks = multicall(w3, [contract.functions.locks(tokenId) for tokenId in token_ids], block,
+                          max_workers=multicall_workers)
+
+        for (address, _), lock in zip(owner_indexes, locks):
+            value = lock[2] + lock[5]  # lockedAmount + maxPayout
+            airdrop_data.append((address, value))
+            journal.append((address, value))
+
+        # Close the segment in the journal (only new records plus a progress marker are written)
+        journal.mark(segment_end)
+        print(f"Processed {segment_end} holders out of {len(holders)}. Intermediary data saved to {filename}")
+    journal.close()
+    return airdrop_data
+
+
+def get_airdrop_amounts(airdrop_data):
+    """Splits the 5M token airdrop pro rata to value, one row per address sorted by amount"""
+    totalValue = sum(value for _, value in airdrop_data)
+
+    # Calculate airdrop amounts
+    airdrop_amounts = [(address, value * 5000000000000000000000000 // totalValue) for address, value in airdrop_data]
+
+    # Group by address
+    address_to_amount = {}
+    for address, amount in airdrop_amounts:
+        if address in address_to_amount:
+            address_to_amount[address] += amount
+        else:
+            address_to_amount[address] = amount
+
+    # Sort by amount
+    dataframe = pd.DataFrame(address_to_amount.items(), columns=['ADDRESS', 'AMOUNT'])
+    dataframe['CHAIN'] = 'polygon'
+    dataframe = dataframe[['CHAIN', 'ADDRESS', 'AMOUNT']]
+    dataframe.sort_values(by='AMOUNT', ascending=False, inplace=True)
+    return dataframe
+
+
+def snapshot(block):
+    """Airdrop amounts for the holders at block"""
+    airdrop_data = get_airdrop_data(get_holders(block), block)
+
+    # Save final airdrop data to file
+    filename = block_filename(airdrop_filename, block)
+    with open(filename, 'w') as file:
+        json.dump(airdrop_data, file)
+    print(f"Saved airdrop data to {filename}")
+
+    return get_airdrop_amounts(airdrop_data)
+
+
+def run(snap_date):
+    """Airdrop amounts for the holders at the last block before snap_date"""
+    return snapshot(get_block_by_timestamp(w3, date_to_timestamp(snap_date)))
+
+
+def main():
+    # Write the default snapshot to CSV
+    snapshot(snapshot_block).to_csv('33.csv', index=False)
+    print('Saved airdrop amounts to 33.csv')
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('33_metrics.json')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,32 @@
 from web3 import Web3
 from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
-import json
+from web3.middleware import geth_poa_middleware
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector
+from hexbytes import HexBytes
 import datetime as dt
-import requests
 import os
+import sys
 from dotenv import load_dotenv
 import pandas as pd
-import re
-from collections import defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.batch_provider import BatchHTTPProvider, batch_map
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.cache import KeyValueStore
+from common.decode import decode_logs
+from common.log_cache import get_cached_logs, get_chain_id
+from common.metrics import dump_metrics, metrics_middleware, report_metrics
+from common.ratelimit import rate_limit_middleware, report_waits
 
 
 load_dotenv()
-ETHERSCAN_API_KEY = os.environ['POLY_ETHERSCAN_API']
 ALCHEMY_URL = os.environ['ALCHEMY_URL_POLY']
-W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL))
+W3 = Web3(BatchHTTPProvider(ALCHEMY_URL))
+W3.middleware_onion.inject(geth_poa_middleware, layer=0)   # Polygon headers have long extraData
+W3.middleware_onion.add(metrics_middleware)   # inside the rate limiter: times requests, not waits
+W3.middleware_onion.add(rate_limit_middleware)
 FROM_BLOCK = 34737085   # block of first USDR transfer
-
-W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL))
+SNAP_DATE = dt.date(2023, 6, 1)
 
 ERC20_ABI = [
     {
@@ -118,28 +127,30 @@ USDR_EXCHANGE_ABI = [
 ]
 
 
-SIMPLE_TX = set()
-COMPLEX_TX = set()
-def is_simple(tx_hash):
-    if tx_hash in SIMPLE_TX:
-        return True
-    if tx_hash in COMPLEX_TX:
-        return False
-    usdr_exchange = '0x195F7B233947d51F4C3b756ad41a5Ddb34cEBCe0'
-    contract = W3.eth.contract(usdr_exchange, abi=USDR_EXCHANGE_ABI)
-    tx_info = W3.eth.get_transaction(tx_hash)
-    if tx_info.to == usdr_exchange:
-        try:
-            function_input = contract.decode_function_input(tx_info.input)
-        except:
-            COMPLEX_TX.add(tx_hash)
-            return False
-        if function_input[0].fn_name == contract.functions.swapFromUnderlying.fn_name or \
-            function_input[0].fn_name == contract.functions.swapToUnderlying.fn_name:
-            SIMPLE_TX.add(tx_hash)
-            return True
-    COMPLEX_TX.add(tx_hash)
-    return False
+USDR_EXCHANGE = '0x195F7B233947d51F4C3b756ad41a5Ddb34cEBCe0'
+SIMPLE_SELECTORS = {function_abi_to_4byte_selector(abi) for abi in USDR_EXCHANGE_ABI}
+TX_CLASSES = KeyValueStore('usdr_simple_tx')
+
+
+def is_simple(tx_info):
+    ''' a simple mint/redeem is a direct call to swapFromUnderlying/swapToUnderlying on the exchange '''
+    return tx_info.to == USDR_EXCHANGE and bytes(HexBytes(tx_info.input)[:4]) in SIMPLE_SELECTORS
+
+
+def classify_transactions(tx_hashes):
+    ''' returns {tx_hash: is_simple}. Classifications are cached on disk by (chain id, tx hash),
+        only new transactions are fetched (concurrently, in JSON-RPC batches) '''
+    chain_id = get_chain_id(W3)
+    keys = {f'{chain_id}:{tx_hash}': tx_hash for tx_hash in tx_hashes}
+    cached = TX_CLASSES.get_many(keys)
+
+    missing = [tx_hash for key, tx_hash in keys.items() if key not in cached]
+    tx_infos = batch_map(W3.eth.get_transaction, missing)
+    new = {f'{chain_id}:{tx_hash}': is_simple(tx_info) for tx_hash, tx_info in zip(missing, tx_infos)}
+    TX_CLASSES.put_many(new)
+
+    cached.update(new)
+    return {tx_hash: cached[key] for key, tx_hash in keys.items()}
 
 
 def get_all_usdr_transfers(token, block_num):
@@ -148,158 +159,100 @@ def get_all_usdr_transfers(token, block_num):
     transfer_event_abi = transfer_event._get_event_abi()
 
     # pull all transfer events:
-    logs_all = []
-    start_block = FROM_BLOCK
-    end_block = block_num
-    while True:
-        try:
-            print(f'trying block {start_block} to {end_block}...')
-            _, event_filter_params = construct_event_filter_params(
-                transfer_event_abi,
-                W3.codec,
-                address=token,
-                argument_filters={'address': token
-                                  },
-                fromBlock=start_block,
-                toBlock=end_block
-            )
-            logs = W3.eth.get_logs(event_filter_params)
-        except ValueError as e:
-            print('failed...')
-            m = re.search('range should work: \[(0x[0-9a-f]*), (0x[0-9a-f]*)\]', str(e))
-            end_block = int(m.group(2), 0)
-            continue
-        except Exception as e:
-            print('unhandled exception:', e)
-            continue
-
-        logs_all.extend(logs)
-        if end_block == block_num:
-            break
-        start_block = end_block
-        end_block = block_num
-    print('done pulling logs.')
+    _, event_filter_params = construct_event_filter_params(
+        transfer_event_abi,
+        W3.codec,
+        address=token,
+        argument_filters={'address': token},
+        fromBlock=FROM_BLOCK,
+        toBlock=block_num
+    )
+    logs_all = get_cached_logs(W3, event_filter_params)
 
     # assemble in DataFrame:
-    df = []
-    for i, log in enumerate(logs_all):
-        evt = get_event_data(W3.codec, transfer_event_abi, log)
-        tx_hash = evt['transactionHash'].hex()
-        print(f'{i}) tx {tx_hash}')
-        if not is_simple(tx_hash):
-            continue
-        args = evt['args']
-        args['from']
-        df.append({
-            'from': args['from'],
-            'to': args['to'],
-            'amount': args['amount'],
-            'tx_hash': tx_hash,
-            'block_num': evt['blockNumber']
-            })
-    df = pd.DataFrame(df)
-    return df
-
-
-def get_all_dai_transfers(token, block_nums):
+    df = decode_logs(W3, transfer_event_abi, logs_all)
+
+    # keep only simple mints/redeems:
+    simple = classify_transactions(set(df.tx_hash))
+    df = df[df.tx_hash.map(simple).astype(bool)]
+    return df[['from', 'to', 'amount', 'tx_hash', 'block_num']].reset_index(drop=True)
+
+
+def get_all_dai_transfers(token, tx_hashes):
+    ''' pulls token Transfer logs straight out of the receipts of tx_hashes
+        (receipt requests are sent concurrently and batched by the provider) '''
     contract = W3.eth.contract(token, abi=ERC20_ABI)
     transfer_event = contract.events.Transfer
     transfer_event_abi = transfer_event._get_event_abi()
+    transfer_topic = event_abi_to_log_topic(transfer_event_abi)
 
-    # pull all transfer events:
-    logs_all = []
-    for i, tx_block_num in enumerate(block_nums):
-        print(f'{i}) trying block {tx_block_num}')
-        _, event_filter_params = construct_event_filter_params(
-            transfer_event_abi,
-            W3.codec,
-            address=token,
-            argument_filters={'address': token},
-            fromBlock=tx_block_num,
-            toBlock=tx_block_num
-        )
-        logs = W3.eth.get_logs(event_filter_params)
-        logs_all.extend(logs)
-    print('done pulling logs.')
+    # pull receipts and keep only the token's transfer events:
+    receipts = batch_map(W3.eth.get_transaction_receipt, list(tx_hashes))
+    logs_all = [log for receipt in receipts for log in receipt['logs']
+                if log['address'] == token and len(log['topics']) > 0 and log['topics'][0] == transfer_topic]
 
     # assemble in DataFrame:
-    df = []
-    for log in logs_all:
-        evt = get_event_data(W3.codec, transfer_event_abi, log)
-        args = evt['args']
-        args['from']
-        df.append({
-            'from': args['from'],
-            'to': args['to'],
-            'amount': args['amount'],
-            'tx_hash': evt['transactionHash'].hex(),
-            'block_num': evt['blockNumber']
-            })
-    df = pd.DataFrame(df)
-    return df
+    df = decode_logs(W3, transfer_event_abi, logs_all)
+    return df[['from', 'to', 'amount', 'tx_hash', 'block_num']]
 
 
-def main():
-    # get block time from etherscan API:
-    snap_time = dt.datetime(2023, 6, 1).replace(tzinfo=dt.timezone.utc).timestamp()
-    response = requests.get('https://api.polygonscan.com/api',
-                            params = {'module': 'block',
-                                      'action': 'getblocknobytime',
-                                      'timestamp': int(snap_time),
-                                      'closest': 'before',
-                                      'apikey': ETHERSCAN_API_KEY})
-    response_json = json.loads(response.content)
-    block_num = int(response_json['result'])
+def get_minter_amounts(df_usdr_xfers, df_dai_xfers):
+    ''' attributes USDR mints (burns) in each tx to the addresses that paid (received)
+        DAI in that tx, pro rata to their net DAI flow. Works on whole frames with
+        group-bys and joins; amounts stay exact Python ints until the final ratio. '''
+    null_addr = '0x0000000000000000000000000000000000000000'
+
+    # net DAI flow per (tx, address):
+    flows = pd.concat([
+        pd.DataFrame({'tx_hash': df_dai_xfers.tx_hash, 'addr': df_dai_xfers['from'], 'balance': -df_dai_xfers.amount}),
+        pd.DataFrame({'tx_hash': df_dai_xfers.tx_hash, 'addr': df_dai_xfers['to'], 'balance': df_dai_xfers.amount})])
+    flows = flows.groupby(['tx_hash', 'addr'], sort=False)['balance'].sum().reset_index()
+
+    # total minted and burned USDR per tx:
+    df_mint = df_usdr_xfers[df_usdr_xfers['from'] == null_addr]
+    mint_amounts = df_mint.groupby('tx_hash')['amount'].sum().rename('usdr_amount')
+    df_burn = df_usdr_xfers[df_usdr_xfers['to'] == null_addr]
+    burn_amounts = (-df_burn.groupby('tx_hash')['amount'].sum()).rename('usdr_amount')
+
+    # mints credit whomever paid DAI, burns penalize whomever received DAI:
+    minters = []
+    for payers, usdr_amounts in [(flows[flows.balance < 0], mint_amounts),
+                                 (flows[flows.balance > 0], burn_amounts)]:
+        payers = payers.join(usdr_amounts, on='tx_hash', how='inner')
+        total_dai = payers.groupby('tx_hash')['balance'].transform('sum')
+        payers = payers.assign(amount=payers.balance / total_dai * payers.usdr_amount)
+        minters.append(payers[['addr', 'amount']])
+
+    minters = pd.concat(minters, ignore_index=True)
+    minters['amount'] = minters.amount.astype('float64')
+    return minters
+
+
+def run(snap_date):
+    ''' USDR minted per address (DAI paid in) up to snap_date '''
+    # get snapshot block from the node:
+    snap_time = date_to_timestamp(snap_date)
+    block_num = get_block_by_timestamp(W3, snap_time)
 
     # pull all transfers for both USDR and DAI:
     real_usd = '0xb5DFABd7fF7F83BAB83995E72A52B97ABb7bcf63'
     dai = '0x8f3Cf7ad23Cd3CaDbD9735AFf958023239c6A063'
     df_usdr_xfers = get_all_usdr_transfers(real_usd, block_num)
-    block_nums = set(df_usdr_xfers.block_num)
-    df_dai_xfers = get_all_dai_transfers(dai, block_nums)
     tx_list = set(df_usdr_xfers.tx_hash)
-    df_dai_xfers = df_dai_xfers[df_dai_xfers.tx_hash.isin(tx_list)]
+    df_dai_xfers = get_all_dai_transfers(dai, tx_list)
+
+    minters = get_minter_amounts(df_usdr_xfers, df_dai_xfers)
+
+    return minters.groupby('addr')['amount'].sum()
 
-    # loop through all tx:
-    null_addr = '0x0000000000000000000000000000000000000000'
-    minter_list = []
-    for i, tx in enumerate(tx_list):
-        # get DAI flow for each address in this tx:
-        dai_balances = defaultdict(int)
-        for _, dai_tx in df_dai_xfers[df_dai_xfers.tx_hash == tx].iterrows():
-            dai_balances[dai_tx['from']] -= dai_tx.amount
-            dai_balances[dai_tx['to']] += dai_tx.amount
-
-        print(f'{i}) tx {tx}')
-        
-        # get mint, distribute credit according to whomever paid for it in DAI:
-        df_mint = df_usdr_xfers[(df_usdr_xfers['from'] == null_addr) & (df_usdr_xfers['tx_hash'] == tx)]        
-        if len(df_mint) > 0:
-            mint_amount = df_mint.amount.sum()
-            total_dai = sum(dai_balances[addr] for addr in dai_balances if dai_balances[addr] < 0)        
-            for addr in dai_balances:
-                balance = dai_balances[addr]
-                if balance >= 0:
-                    continue
-                minter_list.append({
-                    'addr': addr,
-                    'amount': balance / total_dai * mint_amount
-                    })
-
-        # get burn, penalize whomever received DAI:
-        df_burn = df_usdr_xfers[(df_usdr_xfers['to'] == null_addr) & (df_usdr_xfers['tx_hash'] == tx)]
-        if len(df_burn) > 0:
-            burn_amount = -df_burn.amount.sum()
-            total_dai = sum(dai_balances[addr] for addr in dai_balances if dai_balances[addr] > 0)
-            for addr in dai_balances:
-                balance = dai_balances[addr]
-                if balance <= 0:
-                    continue
-                minter_list.append({
-                    'addr': addr,
-                    'amount': balance / total_dai * burn_amount
-                    })
 
+def main():
     # summarize, copy to clipboard, do rest in Excel:
-    df = pd.DataFrame(minter_list)
-    df.groupby('addr')['amount'].sum().to_clipboard()
+    run(SNAP_DATE).to_clipboard()
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('usdr_metrics.json')
+
+
+if __name__ == '__main__':
+    main()
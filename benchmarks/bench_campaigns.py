@@ -0,0 +1,319 @@
+''' end-to-end benchmark of the campaign scripts against a local mock JSON-RPC node
+    (see mock_node.py): each campaign gets a synthetic dataset on its own node with
+    the limits of the provider it uses in production, runs `run(SNAP_DATE)` from a
+    cold cache and then again from the warm one, and reports wall time, requests
+    and bytes on the wire.
+
+    python benchmarks/bench_campaigns.py                       # every campaign
+    python benchmarks/bench_campaigns.py chronos usdr --scale 4
+    python benchmarks/bench_campaigns.py --node-cu-per-second 330   # provoke 429s '''
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from eth_utils import keccak
+
+# the on-disk caches are opened at import time, so point them somewhere empty first:
+os.environ['AIRDROP_CACHE_DIR'] = tempfile.mkdtemp(prefix='airdrop-bench-cache-')
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mock_node import NULL_ADDRESS, MockChain, MockNode, format_stats, make_address, make_hash
+from scripts import load_script
+from common.ratelimit import BUDGETS, SERVICE_HOSTS, report_waits
+
+
+SNAP_DATE = dt.date(2023, 6, 1)
+SNAP_TIME = int(dt.datetime(2023, 6, 1, tzinfo=dt.timezone.utc).timestamp())
+TRANSFER = 'Transfer(address indexed,address indexed,uint256)'
+
+
+def make_chain(chain_id, anchor_block=40_000_000):
+    ''' chain whose block at SNAP_TIME is anchor_block '''
+    return MockChain(chain_id, anchor_block, SNAP_TIME, block_time=2.0)
+
+
+def event_blocks(rng, n, first, last):
+    return sorted(rng.randrange(first, last + 1) for _ in range(n))
+
+
+def build_chronos(scale, rng, workdir):
+    ''' pairs from the factory with LP Transfer histories (starting with the
+        MINIMUM_LIQUIDITY mint to the null address), a gauge on every third pair
+        holding part of its LP tokens, and a price fixture for the tokens '''
+    chain = make_chain(42161)
+    factory = '0xCe9240869391928253Ed9cc9Bcb8cb98CB5B0722'
+    voter = '0xC72b5C6D2C33063E89a50B2F77C99193aE6cEe6c'
+    snap = chain.anchor_block
+
+    tokens = [make_address('chronos-token', i) for i in range(20)]
+    fixture = {'coins': {token: {'id': f'coin-{i}', 'symbol': f'T{i}'} for i, token in enumerate(tokens)},
+               'prices': {f'coin-{i}': {SNAP_DATE.strftime('%d-%m-%Y'): rng.uniform(0.01, 2000)} for i in range(20)}}
+    for i, token in enumerate(tokens):
+        chain.function(token, 'decimals()', ['uint8'], lambda decimals=(18, 6, 8)[i % 3]: decimals)
+
+    for i in range(30 * scale):
+        pair = make_address('chronos-pair', i)
+        token0, token1 = rng.sample(tokens, 2)
+        created = rng.randrange(1, snap // 2)
+        chain.event(factory, 'PairCreated(address indexed,address indexed,bool,address,uint256)',
+                    (token0, token1, i % 2 == 0, pair, i), created)
+        chain.event(pair, TRANSFER, (NULL_ADDRESS, NULL_ADDRESS, 1000), created)
+        supply = 1000
+        holders = [make_address('chronos-lp', rng.randrange(500 * scale)) for _ in range(40)]
+        balances = {}
+        for holder, block in zip(holders, event_blocks(rng, len(holders), created, snap - 2)):
+            amount = rng.randrange(10 ** 15, 10 ** 21)
+            chain.event(pair, TRANSFER, (NULL_ADDRESS, holder, amount), block)
+            balances[holder] = balances.get(holder, 0) + amount
+            supply += amount
+
+        if i % 3 == 0:
+            gauge = make_address('chronos-gauge', i)
+            chain.event(voter, 'GaugeCreated(address indexed,address,address,address indexed,address indexed)',
+                        (gauge, make_address('creator'), make_address('internal-bribe', i),
+                         make_address('external-bribe', i), pair), created)
+            staked = {}
+            for holder in rng.sample(sorted(balances), len(balances) // 2):
+                amount = balances[holder] // 2
+                chain.event(pair, TRANSFER, (holder, gauge, amount), snap - 1)
+                chain.event(gauge, 'Deposit(address indexed,uint256,uint256)', (holder, 0, amount), snap - 1)
+                staked[holder] = amount
+            chain.function(gauge, 'balanceOf(address)', ['uint256'], lambda user, staked=staked: staked.get(user, 0))
+            chain.function(gauge, 'totalSupply()', ['uint256'], lambda staked=staked: sum(staked.values()))
+
+        chain.function(pair, 'totalSupply()', ['uint256'], lambda supply=supply: supply)
+        chain.function(pair, 'name()', ['string'], lambda i=i: f'vAMM-{i}')
+        reserves = (rng.randrange(10 ** 18, 10 ** 24), rng.randrange(10 ** 18, 10 ** 24), SNAP_TIME)
+        chain.function(pair, 'getReserves()', ['uint256', 'uint256', 'uint256'], lambda reserves=reserves: reserves)
+
+    fixture_path = os.path.join(workdir, 'prices.json')
+    with open(fixture_path, 'w') as file:
+        json.dump(fixture, file)
+    os.environ['AIRDROP_PRICE_FIXTURE'] = fixture_path
+    return chain
+
+
+def build_convex_ethereum(scale, rng, workdir):
+    ''' Booster Deposited events and BaseRewardPools with Staked/Withdrawn histories,
+        about a fifth of the depositors fully withdrawn '''
+    chain = make_chain(1, anchor_block=17_382_000)
+    booster = '0xF403C135812408BFbE8713b5A23a04b3D48AAE31'
+    snap = chain.anchor_block
+    pool_infos = {}
+    chain.function(booster, 'poolInfo(uint256)', ['address', 'address', 'address', 'address', 'address', 'bool'],
+                   lambda pool_id: pool_infos[pool_id])
+    for pool_id in range(20 * scale):
+        lp_token, reward_pool = make_address('convex-lp', pool_id), make_address('convex-rewards', pool_id)
+        pool_infos[pool_id] = (lp_token, NULL_ADDRESS, NULL_ADDRESS, reward_pool, NULL_ADDRESS, False)
+        stakes = {}
+        for block in event_blocks(rng, 100, 1, snap - 2):
+            user = make_address('convex-user', rng.randrange(1000 * scale))
+            amount = rng.randrange(10 ** 15, 10 ** 21)
+            chain.event(booster, 'Deposited(address indexed,uint256 indexed,uint256)', (user, pool_id, amount), block)
+            chain.event(reward_pool, 'Staked(address indexed,uint256)', (user, amount), block)
+            stakes[user] = stakes.get(user, 0) + amount
+        for user in rng.sample(sorted(stakes), len(stakes) // 5):
+            chain.event(reward_pool, 'Withdrawn(address indexed,uint256)', (user, stakes.pop(user)), snap - 1)
+        chain.function(reward_pool, 'balanceOf(address)', ['uint256'], lambda user, stakes=stakes: stakes.get(user, 0))
+        chain.function(reward_pool, 'totalSupply()', ['uint256'], lambda stakes=stakes: sum(stakes.values()))
+    return chain
+
+
+def build_convex_polygon(scale, rng, workdir):
+    ''' Booster Deposited events and tokenized reward pools whose Transfer events
+        track the stakes (deposits mint, withdrawals burn, some stakes move) '''
+    chain = make_chain(137, anchor_block=43_386_770)
+    booster = '0xF403C135812408BFbE8713b5A23a04b3D48AAE31'
+    snap = chain.anchor_block
+    pool_infos = {}
+    chain.function(booster, 'poolInfo(uint256)', ['address', 'address', 'address', 'bool', 'address'],
+                   lambda pool_id: pool_infos[pool_id])
+    for pool_id in range(10 * scale):
+        lp_token, reward_pool = make_address('convex-poly-lp', pool_id), make_address('convex-poly-rewards', pool_id)
+        pool_infos[pool_id] = (lp_token, NULL_ADDRESS, reward_pool, False, NULL_ADDRESS)
+        balances = {}
+        for block in event_blocks(rng, 100, 1, snap - 10):
+            user = make_address('convex-poly-user', rng.randrange(1000 * scale))
+            amount = rng.randrange(10 ** 15, 10 ** 21)
+            chain.event(booster, 'Deposited(address indexed,uint256 indexed,uint256)', (user, pool_id, amount), block)
+            chain.event(reward_pool, TRANSFER, (NULL_ADDRESS, user, amount), block)
+            balances[user] = balances.get(user, 0) + amount
+        for user in rng.sample(sorted(balances), len(balances) // 5):
+            chain.event(reward_pool, TRANSFER, (user, NULL_ADDRESS, balances.pop(user)), snap - 2)
+        for user in rng.sample(sorted(balances), len(balances) // 10):
+            receiver = make_address('convex-poly-user', rng.randrange(1000 * scale))
+            amount = balances.pop(user)
+            chain.event(reward_pool, TRANSFER, (user, receiver, amount), snap - 1)
+            balances[receiver] = balances.get(receiver, 0) + amount
+        chain.function(reward_pool, 'balanceOf(address)', ['uint256'],
+                       lambda user, balances=balances: balances.get(user, 0))
+        chain.function(reward_pool, 'totalSupply()', ['uint256'], lambda balances=balances: sum(balances.values()))
+    return chain
+
+
+def build_usdr(scale, rng, workdir):
+    ''' USDR mints and burns, each in a transaction with its DAI legs in the receipt;
+        about a quarter go through a router and are not simple exchange calls '''
+    chain = make_chain(137, anchor_block=43_386_770)
+    real_usd = '0xb5DFABd7fF7F83BAB83995E72A52B97ABb7bcf63'
+    dai = '0x8f3Cf7ad23Cd3CaDbD9735AFf958023239c6A063'
+    exchange = '0x195F7B233947d51F4C3b756ad41a5Ddb34cEBCe0'
+    router = make_address('usdr-router')
+    swap_from = '0x' + keccak(text='swapFromUnderlying(uint256,address)')[:4].hex()
+    swap_to = '0x' + keccak(text='swapToUnderlying(uint256,address)')[:4].hex()
+
+    for i, block in enumerate(event_blocks(rng, 2000 * scale, 34_737_085, chain.anchor_block)):
+        user = make_address('usdr-user', rng.randrange(500 * scale))
+        amount = rng.randrange(10 ** 18, 10 ** 24)
+        mint = rng.random() < 0.6
+        tx_hash = make_hash('usdr-tx', i)
+        simple = rng.random() < 0.75
+        chain.transaction(tx_hash, user, exchange if simple else router,
+                          (swap_from if mint else swap_to) + '00' * 64, block)
+        if mint:
+            chain.event(dai, TRANSFER, (user, exchange, amount), block, tx_hash)
+            chain.event(real_usd, TRANSFER, (NULL_ADDRESS, user, amount // 10 ** 9), block, tx_hash)
+        else:
+            chain.event(real_usd, TRANSFER, (user, NULL_ADDRESS, amount // 10 ** 9), block, tx_hash)
+            chain.event(dai, TRANSFER, (exchange, user, amount), block, tx_hash)
+    return chain
+
+
+def build_vechr(scale, rng, workdir):
+    ''' veCHR lock mints, a third of them from airdrop claims (same transaction) '''
+    chain = make_chain(42161)
+    vechr = '0x9A01857f33aa382b1d5bb96C3180347862432B0d'
+    airdrop = '0xCA830F6d34D03c07b2A79021186C2eE4E0A3Da58'
+    owners, balances = {}, {}
+    for token_id, block in enumerate(event_blocks(rng, 1000 * scale, 1, chain.anchor_block), start=1):
+        owner = make_address('vechr-user', rng.randrange(300 * scale))
+        tx_hash = make_hash('vechr-tx', token_id)
+        chain.event(vechr, 'Transfer(address indexed,address indexed,uint256 indexed)',
+                    (NULL_ADDRESS, owner, token_id), block, tx_hash)
+        if token_id % 3 == 0:
+            chain.event(airdrop, 'Claimed(address,uint256)', (owner, 10 ** 18), block, tx_hash)
+        owners[token_id] = owner
+        balances[token_id] = rng.randrange(10 ** 18, 10 ** 23)
+    chain.function(vechr, 'ownerOf(uint256)', ['address'], lambda token_id: owners.get(token_id, NULL_ADDRESS))
+    chain.function(vechr, 'balanceOfNFT(uint256)', ['uint256'], lambda token_id: balances.get(token_id, 0))
+    return chain
+
+
+def build_vevelo(scale, rng, workdir):
+    ''' veNFTs 1..n with owners and voting power (burnt ids owned by the null address) '''
+    chain = make_chain(10, anchor_block=104_000_000)
+    venft = '0x9c7305eb78a432ced5C4D14Cac27E8Ed569A2e26'
+    n_tokens = 500 * scale
+    owners = {token_id: make_address('velo-user', rng.randrange(200 * scale)) if rng.random() < 0.9 else NULL_ADDRESS
+              for token_id in range(1, n_tokens)}
+    powers = {token_id: rng.randrange(10 ** 18, 10 ** 23) for token_id in owners}
+    chain.function(venft, 'ownerOf(uint256)', ['address'], lambda token_id: owners.get(token_id, NULL_ADDRESS))
+    chain.function(venft, 'balanceOfAtNFT(uint256,uint256)', ['uint256'],
+                   lambda token_id, block_num: powers.get(token_id, 0))
+    return chain, {'max_token_id': n_tokens}
+
+
+def build_tangible(scale, rng, workdir):
+    ''' TNGBL 33 holders (as Covalent lists them) with one to three locks each '''
+    chain = make_chain(137, anchor_block=43_386_770)
+    nft = '0xDc7ee66c43f35aC8C1d12Df90e61f05fbc2cd2c1'
+    holders = [make_address('tngbl-holder', i) for i in range(1000 * scale)]
+    tokens = {}
+    locks = {}
+    for holder in holders:
+        tokens[holder] = []
+        for _ in range(rng.randrange(1, 4)):
+            token_id = len(locks) + 1
+            locks[token_id] = (0, 0, rng.randrange(10 ** 18, 10 ** 22), 1, 0, rng.randrange(10 ** 18, 10 ** 22))
+            tokens[holder].append(token_id)
+    chain.function(nft, 'balanceOf(address)', ['uint256'], lambda owner: len(tokens.get(owner, [])))
+    chain.function(nft, 'tokenOfOwnerByIndex(address,uint256)', ['uint256'], lambda owner, index: tokens[owner][index])
+    chain.function(nft, 'locks(uint256)', ['uint256'] * 6, lambda token_id: locks[token_id])
+
+    # the holder list comes from Covalent, which the benchmark doesn't mock - use the local file:
+    with open(os.path.join(workdir, 'holders.json'), 'w') as file:
+        json.dump([{'address': holder.lower()} for holder in holders], file)
+    return chain
+
+
+# campaign: (script, world builder, env var of the endpoint, client-side service, node profile)
+CAMPAIGNS = {
+    'chronos': ('Chronos LPs/chronos.py', build_chronos, 'ALCHEMY_URL_ARB', 'alchemy', 'alchemy'),
+    'convex_ethereum': ('Convex Ethereum LPs/convex_ethereum.py', build_convex_ethereum, 'ALCHEMY_URL_ETH',
+                        'alchemy', 'alchemy'),
+    'convex_polygon': ('Convex Polygon LPs/convex_polygon.py', build_convex_polygon, 'ALCHEMY_URL_POLY',
+                       'alchemy', 'alchemy'),
+    'usdr': ('USDR minters/USDR_minting.py', build_usdr, 'ALCHEMY_URL_POLY', 'alchemy', 'alchemy'),
+    'vechr': ('veCHR minters/vechr_airdrop.py', build_vechr, 'ALCHEMY_URL_ARB', 'alchemy', 'alchemy'),
+    'vevelo': ('veVELO holders/velodrome_airdrop_async.py', build_vevelo, 'ALCHEMY_URL_OPT', 'alchemy', 'alchemy'),
+    'tangible': ('TNGBL 33/tangible_33p_airdrop.py', build_tangible, 'POLYGON_RPC_URL', 'polygon-rpc', 'public'),
+}
+
+
+def timed_run(module, node):
+    ''' wall time and node counters of one run(SNAP_DATE) '''
+    node.stats.clear()
+    node.methods.clear()
+    start = time.perf_counter()
+    result = module.run(SNAP_DATE)
+    return time.perf_counter() - start, len(result), format_stats(node)
+
+
+def bench(name, scale, seed, node_overrides):
+    script, build, env_var, service, profile = CAMPAIGNS[name]
+    workdir = tempfile.mkdtemp(prefix=f'airdrop-bench-{name}-')
+    world = build(scale, random.Random(seed), workdir)
+    chain, module_overrides = world if isinstance(world, tuple) else (world, {})
+
+    cwd = os.getcwd()
+    # the mock node's host is billed like the provider the campaign really uses:
+    SERVICE_HOSTS.insert(0, ('127.0.0.1', service))
+    try:
+        with MockNode(chain, profile, **node_overrides) as node:
+            os.environ[env_var] = node.url
+            os.chdir(workdir)   # scripts write their journals and holder files to the working dir
+            module = load_script(script, f'bench_{name}')
+            for key, value in module_overrides.items():
+                setattr(module, key, value)
+            for label in ('cold', 'warm'):
+                seconds, rows, stats = timed_run(module, node)
+                print(f'{name} ({label} cache): {seconds:.2f}s, {rows} rows\n    {stats}')
+    finally:
+        os.chdir(cwd)
+        SERVICE_HOSTS.remove(('127.0.0.1', service))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the campaign scripts against a mock JSON-RPC node')
+    parser.add_argument('campaigns', nargs='*', help=f'any of {", ".join(CAMPAIGNS)} (default: all)')
+    parser.add_argument('--scale', type=int, default=1, help='multiplies the size of every synthetic dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, help='seconds per HTTP request (default: the profile\'s)')
+    parser.add_argument('--node-cu-per-second', type=float, help='compute units/s the node serves before 429s')
+    parser.add_argument('--client-budget', type=float, help='override the client-side Alchemy budget (CU/s)')
+    args = parser.parse_args()
+
+    names = args.campaigns or list(CAMPAIGNS)
+    unknown = [name for name in names if name not in CAMPAIGNS]
+    if unknown:
+        parser.error(f'unknown campaigns: {", ".join(unknown)}')
+    if args.client_budget is not None:
+        BUDGETS['alchemy'] = args.client_budget
+    node_overrides = {}
+    if args.latency is not None:
+        node_overrides['latency'] = args.latency
+    if args.node_cu_per_second is not None:
+        node_overrides['cu_per_second'] = args.node_cu_per_second
+
+    for name in names:
+        bench(name, args.scale, args.seed, node_overrides)
+    print(report_waits())
+
+
+if __name__ == '__main__':
+    main()
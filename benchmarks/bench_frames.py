@@ -0,0 +1,53 @@
+''' compares growing a DataFrame with df.loc[key] = ... against collecting column
+    buffers and calling build_frame once (what the collectors do now).
+
+    python benchmarks/bench_frames.py '''
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.frames import build_frame
+
+
+def make_rows(n):
+    return [(f'0x{i:040x}', i * 10 ** 18, i / n) for i in range(n)]
+
+
+def loc_growth(rows):
+    df = pd.DataFrame(columns=['balance', 'pct_own'])
+    df.index.name = 'owner'
+    for owner, balance, pct_own in rows:
+        df.loc[owner] = balance, pct_own
+    return df
+
+
+def column_buffers(rows):
+    owners, balances, pct_owns = [], [], []
+    for owner, balance, pct_own in rows:
+        owners.append(owner)
+        balances.append(balance)
+        pct_owns.append(pct_own)
+    return build_frame(owners, {'balance': balances, 'pct_own': pct_owns}, index_name='owner',
+                       dtypes={'balance': 'float64', 'pct_own': 'float64'})
+
+
+def timed(fn, rows):
+    start = time.perf_counter()
+    fn(rows)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f'{"rows":>10} {"df.loc (s)":>12} {"buffers (s)":>12} {"buffers us/row":>15}')
+    for n in [1_000, 10_000, 100_000, 1_000_000]:
+        rows = make_rows(n)
+        loc_time = timed(loc_growth, rows) if n <= 10_000 else float('nan')
+        buffer_time = timed(column_buffers, rows)
+        print(f'{n:>10} {loc_time:>12.3f} {buffer_time:>12.3f} {buffer_time / n * 1e6:>15.3f}')
+
+
+if __name__ == '__main__':
+    main()
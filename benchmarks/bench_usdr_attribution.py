@@ -0,0 +1,88 @@
+''' benchmarks USDR mint/burn attribution (get_minter_amounts) on synthetic transfers
+    and checks it against the previous per-transaction loop.
+
+    python benchmarks/bench_usdr_attribution.py '''
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from scripts import load_script
+
+
+NULL_ADDR = '0x0000000000000000000000000000000000000000'
+EXCHANGE = '0x195F7B233947d51F4C3b756ad41a5Ddb34cEBCe0'
+
+
+def make_transfers(n_tx, n_users=50_000, seed=0):
+    ''' one mint or burn per tx, DAI moving between the user, the exchange and sometimes a router '''
+    rng = random.Random(seed)
+    usdr, dai = [], []
+    for i in range(n_tx):
+        tx = f'0x{i:064x}'
+        user = f'0x{rng.randrange(n_users):040x}'
+        router = f'0x{n_users + rng.randrange(100):040x}'
+        amount = rng.randrange(1, 10 ** 24)
+        if rng.random() < 0.6:
+            usdr.append((NULL_ADDR, user, amount // 10 ** 9, tx))
+            dai.append((user, router, amount, tx))
+            dai.append((router, EXCHANGE, amount, tx))
+        else:
+            usdr.append((user, NULL_ADDR, amount // 10 ** 9, tx))
+            dai.append((EXCHANGE, user, amount, tx))
+    columns = ['from', 'to', 'amount', 'tx_hash']
+    return pd.DataFrame(usdr, columns=columns), pd.DataFrame(dai, columns=columns)
+
+
+def get_minter_amounts_loop(df_usdr_xfers, df_dai_xfers):
+    ''' the per-transaction implementation this replaced, kept as a reference '''
+    minter_list = []
+    for tx in set(df_usdr_xfers.tx_hash):
+        dai_balances = defaultdict(int)
+        for _, dai_tx in df_dai_xfers[df_dai_xfers.tx_hash == tx].iterrows():
+            dai_balances[dai_tx['from']] -= dai_tx.amount
+            dai_balances[dai_tx['to']] += dai_tx.amount
+        df_mint = df_usdr_xfers[(df_usdr_xfers['from'] == NULL_ADDR) & (df_usdr_xfers['tx_hash'] == tx)]
+        if len(df_mint) > 0:
+            mint_amount = df_mint.amount.sum()
+            total_dai = sum(dai_balances[addr] for addr in dai_balances if dai_balances[addr] < 0)
+            for addr, balance in dai_balances.items():
+                if balance < 0:
+                    minter_list.append({'addr': addr, 'amount': balance / total_dai * mint_amount})
+        df_burn = df_usdr_xfers[(df_usdr_xfers['to'] == NULL_ADDR) & (df_usdr_xfers['tx_hash'] == tx)]
+        if len(df_burn) > 0:
+            burn_amount = -df_burn.amount.sum()
+            total_dai = sum(dai_balances[addr] for addr in dai_balances if dai_balances[addr] > 0)
+            for addr, balance in dai_balances.items():
+                if balance > 0:
+                    minter_list.append({'addr': addr, 'amount': balance / total_dai * burn_amount})
+    return pd.DataFrame(minter_list)
+
+
+def main():
+    usdr_minting = load_script('USDR minters/USDR_minting.py')
+
+    # correctness against the old loop on a small sample:
+    df_usdr, df_dai = make_transfers(2_000)
+    expected = get_minter_amounts_loop(df_usdr, df_dai).groupby('addr')['amount'].sum()
+    actual = usdr_minting.get_minter_amounts(df_usdr, df_dai).groupby('addr')['amount'].sum()
+    assert expected.index.equals(actual.index)
+    assert np.allclose(expected.values, actual.values, rtol=1e-12, atol=0)
+    print(f'matches per-tx loop on {len(df_usdr)} txs')
+
+    print(f'{"DAI transfers":>14} {"seconds":>8} {"transfers/s":>12}')
+    for n_tx in [10_000, 100_000, 1_000_000]:
+        df_usdr, df_dai = make_transfers(n_tx)
+        start = time.perf_counter()
+        usdr_minting.get_minter_amounts(df_usdr, df_dai)
+        elapsed = time.perf_counter() - start
+        print(f'{len(df_dai):>14} {elapsed:>8.2f} {len(df_dai) / elapsed:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
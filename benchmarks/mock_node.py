@@ -0,0 +1,424 @@
+''' local stand-in for a JSON-RPC provider, so the campaign scripts can be run and
+    measured offline. A MockChain holds a synthetic dataset (event logs, contract
+    functions, transactions and receipts, block headers); a MockNode serves it over
+    HTTP and simulates a provider profile: eth_getLogs range/result limits with that
+    provider's error message, latency, a compute-unit budget answered with 429s, and
+    a maximum batch size. Requests, methods, errors and bytes on the wire are counted.
+
+    Contract state is static: eth_call answers with the state at the snapshot no
+    matter which block is asked for, which is what the scripts read anyway. '''
+import bisect
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import decode, encode
+from eth_utils import keccak, to_checksum_address
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.multicall import MULTICALL3
+from common.ratelimit import ALCHEMY_DEFAULT_COST, ALCHEMY_METHOD_COSTS
+
+
+NULL_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+class Revert(Exception):
+    ''' raise from a mock function to make the eth_call revert '''
+
+
+def make_address(*parts):
+    ''' deterministic checksummed address for a label, e.g. make_address('user', 17) '''
+    return to_checksum_address(keccak(text=':'.join(map(str, parts)))[-20:])
+
+
+def make_hash(*parts):
+    return '0x' + keccak(text=':'.join(map(str, parts))).hex()
+
+
+def parse_signature(signature):
+    ''' 'Transfer(address indexed,address indexed,uint256)' -> ('Transfer', [(type, indexed)], canonical) '''
+    name, args = signature.rstrip(')').split('(', 1)
+    inputs = []
+    for arg in filter(None, args.split(',')):
+        words = arg.split()
+        inputs.append((words[0], 'indexed' in words[1:]))
+    return name, inputs, f'{name}({",".join(arg_type for arg_type, _ in inputs)})'
+
+
+def hex_int(value):
+    return hex(int(value))
+
+
+class MockChain:
+    ''' synthetic chain data. Block timestamps are linear around an anchor block
+        (anchor_time at anchor_block, block_time seconds per block), so a snapshot
+        date resolves to a known block. '''
+
+    def __init__(self, chain_id, anchor_block, anchor_time, block_time=2.0, head_block=None):
+        self.chain_id = chain_id
+        self.anchor_block = anchor_block
+        self.anchor_time = anchor_time
+        self.block_time = block_time
+        self.head_block = head_block or anchor_block + 100_000
+        self.logs = defaultdict(list)         # address -> [(block, log_index, log)], sorted on use
+        self._sorted = set()
+        self._log_indexes = Counter()         # block -> next log index
+        self.functions = {}                   # (address, selector) -> (input types, output types, fn)
+        self.transactions = {}
+        self.receipts = {}
+        self._lock = threading.Lock()
+
+    def timestamp(self, block_num):
+        return max(0, int(self.anchor_time + (block_num - self.anchor_block) * self.block_time))
+
+    def header(self, block_num):
+        return {
+            'number': hex_int(block_num),
+            'hash': make_hash('block', self.chain_id, block_num),
+            'parentHash': make_hash('block', self.chain_id, block_num - 1),
+            'timestamp': hex_int(self.timestamp(block_num)),
+            'miner': NULL_ADDRESS,
+            'extraData': '0x',
+            'gasLimit': hex_int(30_000_000),
+            'gasUsed': '0x0',
+            'difficulty': '0x0',
+            'totalDifficulty': '0x0',
+            'nonce': '0x0000000000000000',
+            'sha3Uncles': make_hash('uncles'),
+            'logsBloom': '0x' + '00' * 256,
+            'transactionsRoot': make_hash('transactions', block_num),
+            'stateRoot': make_hash('state', block_num),
+            'receiptsRoot': make_hash('receipts', block_num),
+            'size': '0x0',
+            'transactions': [],
+            'uncles': []}
+
+    def event(self, address, signature, args, block_num, tx_hash=None):
+        ''' emits an event log, e.g. event(token, 'Transfer(address indexed,address indexed,uint256)',
+            (sender, receiver, amount), block). Returns the log as served by eth_getLogs. '''
+        _, inputs, canonical = parse_signature(signature)
+        topics = ['0x' + keccak(text=canonical).hex()]
+        data_types, data_values = [], []
+        for (arg_type, indexed), value in zip(inputs, args):
+            if indexed:
+                topics.append('0x' + encode([arg_type], [value]).hex())
+            else:
+                data_types.append(arg_type)
+                data_values.append(value)
+        tx_hash = tx_hash or make_hash('tx', self.chain_id, address, block_num, self._log_indexes[block_num])
+        log = {
+            'address': address.lower(),
+            'topics': topics,
+            'data': '0x' + encode(data_types, data_values).hex(),
+            'blockNumber': hex_int(block_num),
+            'blockHash': make_hash('block', self.chain_id, block_num),
+            'transactionHash': tx_hash,
+            'transactionIndex': '0x0',
+            'logIndex': hex_int(self._log_indexes[block_num]),
+            'removed': False}
+        self._log_indexes[block_num] += 1
+        self.logs[address.lower()].append((block_num, int(log['logIndex'], 16), log))
+        self._sorted.discard(address.lower())
+        if tx_hash in self.receipts:
+            self.receipts[tx_hash]['logs'].append(log)
+        return log
+
+    def function(self, address, signature, output_types, fn):
+        ''' registers a view function: fn(*decoded args) returns the output value(s)
+            (a tuple for several outputs) or raises Revert '''
+        _, inputs, canonical = parse_signature(signature)
+        selector = keccak(text=canonical)[:4]
+        self.functions[(address.lower(), selector)] = ([arg_type for arg_type, _ in inputs], list(output_types), fn)
+
+    def transaction(self, tx_hash, sender, to, input_data, block_num):
+        ''' registers a transaction and an empty receipt; logs emitted with the same
+            tx_hash afterwards are added to the receipt '''
+        common = {
+            'blockHash': make_hash('block', self.chain_id, block_num),
+            'blockNumber': hex_int(block_num),
+            'from': sender.lower(),
+            'to': to.lower(),
+            'transactionIndex': '0x0'}
+        self.transactions[tx_hash] = dict(common, hash=tx_hash, input=input_data, value='0x0', gas='0x0',
+                                          gasPrice='0x0', nonce='0x0', type='0x0', v='0x0', r='0x0', s='0x0')
+        self.receipts[tx_hash] = dict(common, transactionHash=tx_hash, status='0x1', gasUsed='0x0',
+                                      cumulativeGasUsed='0x0', contractAddress=None, logs=[],
+                                      logsBloom='0x' + '00' * 256, type='0x0', effectiveGasPrice='0x0')
+
+    def call(self, to, data):
+        ''' runs a registered function (Multicall3 aggregate3 included), returns bytes '''
+        selector, args = bytes(data[:4]), bytes(data[4:])
+        if to.lower() == MULTICALL3.lower() and selector == keccak(text='aggregate3((address,bool,bytes)[])')[:4]:
+            results = []
+            for target, allow_failure, call_data in decode(['(address,bool,bytes)[]'], args)[0]:
+                try:
+                    results.append((True, self.call(target, call_data)))
+                except Revert:
+                    if not allow_failure:
+                        raise
+                    results.append((False, b''))
+            return encode(['(bool,bytes)[]'], [results])
+
+        function = self.functions.get((to.lower(), selector))
+        if function is None:
+            raise Revert(f'no function {selector.hex()} on {to}')
+        input_types, output_types, fn = function
+        # eth_abi decodes addresses lowercased, the datasets are keyed by checksummed ones:
+        args = [to_checksum_address(arg) if arg_type == 'address' else arg
+                for arg_type, arg in zip(input_types, decode(input_types, args))]
+        try:
+            result = fn(*args)
+        except LookupError as e:   # e.g. a token id or pool id the dataset doesn't have
+            raise Revert(f'{selector.hex()} on {to}: no entry for {e}')
+        if len(output_types) == 1:
+            result = (result,)
+        return encode(output_types, list(result))
+
+    def get_logs(self, address, topics, from_block, to_block):
+        addresses = address if isinstance(address, list) else [address] if address else list(self.logs)
+        logs = []
+        for addr in addresses:
+            addr = addr.lower()
+            with self._lock:
+                if addr not in self._sorted:
+                    self.logs[addr].sort(key=lambda entry: entry[:2])
+                    self._sorted.add(addr)
+            entries = self.logs.get(addr, [])
+            start = bisect.bisect_left(entries, (from_block, -1))
+            stop = bisect.bisect_right(entries, (to_block, float('inf')))
+            for _, _, log in entries[start:stop]:
+                if all(wanted is None or log['topics'][i:i + 1] and
+                       log['topics'][i] in (wanted if isinstance(wanted, list) else [wanted])
+                       for i, wanted in enumerate(topics or [])):
+                    logs.append(log)
+        return sorted(logs, key=lambda log: (int(log['blockNumber'], 16), int(log['logIndex'], 16)))
+
+
+class RpcError(Exception):
+    def __init__(self, kind, error):
+        super().__init__(error['message'])
+        self.kind = kind
+        self.error = error
+
+
+class ProviderProfile:
+    ''' what a provider accepts and how it says no '''
+
+    def __init__(self, name, max_block_range=None, max_results=None, range_requires_both=False,
+                 range_error=(-32602, 'block range too large'), latency=0.0, per_item_latency=0.0,
+                 cu_per_second=None, max_batch=None):
+        self.name = name
+        self.max_block_range = max_block_range
+        self.max_results = max_results
+        self.range_requires_both = range_requires_both   # only reject if both limits are exceeded
+        self.range_error = range_error
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.cu_per_second = cu_per_second
+        self.max_batch = max_batch
+
+    def log_range_error(self, from_block, to_block, n_results):
+        too_wide = self.max_block_range is not None and to_block - from_block + 1 > self.max_block_range
+        too_many = self.max_results is not None and n_results > self.max_results
+        if (too_wide and too_many) if self.range_requires_both else (too_wide or too_many):
+            code, message = self.range_error
+            return {'code': code, 'message': message.format(from_block=hex(from_block),
+                                                            to_block=hex(from_block + (self.max_block_range or 1) - 1))}
+        return None
+
+
+PROFILES = {
+    # any range up to 10K logs, or up to 2K blocks with any number of logs:
+    'alchemy': dict(max_block_range=2000, max_results=10_000, range_requires_both=True,
+                    range_error=(-32602, 'Log response size exceeded. You can make eth_getLogs requests with up to '
+                                         'a 2K block range and no limit on the response size, or you can request any '
+                                         'block range with a cap of 10K logs in the response. Based on your parameters '
+                                         'and the response size limit, this block range should work: '
+                                         '[{from_block}, {to_block}]'),
+                    latency=0.05, per_item_latency=0.001, max_batch=1000),
+    'infura': dict(max_results=10_000, range_error=(-32005, 'query returned more than 10000 results'),
+                   latency=0.05, per_item_latency=0.001, max_batch=1000),
+    'public': dict(max_block_range=3500, range_error=(-32000, 'exceed maximum block range: 3500'),
+                   latency=0.15, per_item_latency=0.002, max_batch=100),
+    'unlimited': dict(),
+}
+
+RATE_LIMITED = {'code': 429, 'message': 'Your app has exceeded its compute units per second capacity. If you have '
+                                        'retries enabled, you can safely ignore this message. If not, check out '
+                                        'https://docs.alchemy.com/reference/throughput'}
+
+
+class MockNode:
+    ''' serves a MockChain over JSON-RPC (single requests and batch arrays) on
+        127.0.0.1; use as a context manager and point the script's endpoint at .url '''
+
+    def __init__(self, chain, profile='alchemy', port=0, **overrides):
+        self.chain = chain
+        self.profile = ProviderProfile(profile, **dict(PROFILES[profile], **overrides))
+        self.stats = Counter()
+        self.methods = Counter()
+        self._stats_lock = threading.Lock()
+        self._budget = None
+        self._budget_time = time.monotonic()
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, response = node.handle(body)
+                payload = json.dumps(response).encode()
+                gzipped = 'gzip' in self.headers.get('Accept-Encoding', '') and len(payload) > 1024
+                if gzipped:
+                    payload = gzip.compress(payload, compresslevel=1)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                node.count(bytes_in=len(body), bytes_out=len(payload))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+    def count(self, **counts):
+        with self._stats_lock:
+            self.stats.update(counts)
+
+    def _spend(self, units):
+        ''' takes units from the per-second compute budget; False if it's exhausted '''
+        if self.profile.cu_per_second is None:
+            return True
+        with self._stats_lock:
+            now = time.monotonic()
+            if self._budget is None:
+                self._budget = self.profile.cu_per_second
+            self._budget = min(self.profile.cu_per_second,
+                               self._budget + (now - self._budget_time) * self.profile.cu_per_second)
+            self._budget_time = now
+            if self._budget < units:
+                return False
+            self._budget -= units
+            return True
+
+    def handle(self, body):
+        ''' returns (HTTP status, JSON response) for a request body '''
+        request = json.loads(body)
+        requests = request if isinstance(request, list) else [request]
+        self.count(http_requests=1, rpc_requests=len(requests), batches=isinstance(request, list))
+        with self._stats_lock:
+            self.methods.update(item.get('method') for item in requests)
+
+        if self.profile.max_batch is not None and len(requests) > self.profile.max_batch:
+            self.count(batch_rejected=1)
+            return 200, {'jsonrpc': '2.0', 'id': None,
+                         'error': {'code': -32600, 'message': f'batch size exceeds {self.profile.max_batch}'}}
+        # like Alchemy, items of a batch are charged one by one, and the ones over budget
+        # are answered with a 429 error each; a single request over budget gets an HTTP 429:
+        allowed = [self._spend(ALCHEMY_METHOD_COSTS.get(item.get('method'), ALCHEMY_DEFAULT_COST))
+                   for item in requests]
+        if not isinstance(request, list) and not allowed[0]:
+            self.count(rate_limited=1)
+            return 429, {'jsonrpc': '2.0', 'id': None, 'error': RATE_LIMITED}
+
+        time.sleep(self.profile.latency + self.profile.per_item_latency * sum(allowed))
+        responses = []
+        for item, ok in zip(requests, allowed):
+            if ok:
+                responses.append(self.dispatch(item))
+            else:
+                self.count(rate_limited=1)
+                responses.append({'jsonrpc': '2.0', 'id': item.get('id'), 'error': RATE_LIMITED})
+        return 200, responses if isinstance(request, list) else responses[0]
+
+    def dispatch(self, item):
+        method, params = item.get('method'), item.get('params') or []
+        handler = getattr(self, f'rpc_{method}', None)
+        if handler is None:
+            self.count(error_method=1)
+            return {'jsonrpc': '2.0', 'id': item.get('id'),
+                    'error': {'code': -32601, 'message': f'the method {method} does not exist/is not available'}}
+        try:
+            return {'jsonrpc': '2.0', 'id': item.get('id'), 'result': handler(*params)}
+        except RpcError as e:
+            self.count(**{f'error_{e.kind}': 1})
+            return {'jsonrpc': '2.0', 'id': item.get('id'), 'error': e.error}
+
+    def block_number(self, tag):
+        if tag in (None, 'latest', 'pending', 'safe', 'finalized'):
+            return self.chain.head_block
+        if tag == 'earliest':
+            return 0
+        return int(tag, 16) if isinstance(tag, str) else int(tag)
+
+    def rpc_eth_chainId(self):
+        return hex(self.chain.chain_id)
+
+    def rpc_net_version(self):
+        return str(self.chain.chain_id)
+
+    def rpc_eth_blockNumber(self):
+        return hex(self.chain.head_block)
+
+    def rpc_eth_getBlockByNumber(self, tag, full=False):
+        block_num = self.block_number(tag)
+        return self.chain.header(block_num) if block_num <= self.chain.head_block else None
+
+    def rpc_eth_getTransactionByHash(self, tx_hash):
+        return self.chain.transactions.get(tx_hash)
+
+    def rpc_eth_getTransactionReceipt(self, tx_hash):
+        return self.chain.receipts.get(tx_hash)
+
+    def rpc_eth_call(self, transaction, tag='latest'):
+        data = bytes.fromhex(transaction.get('data', transaction.get('input', '0x'))[2:])
+        try:
+            return '0x' + self.chain.call(transaction['to'], data).hex()
+        except Revert as e:
+            raise RpcError('revert', {'code': 3, 'message': f'execution reverted: {e}'})
+
+    def rpc_eth_getLogs(self, filter_params):
+        from_block = self.block_number(filter_params.get('fromBlock', 'latest'))
+        to_block = self.block_number(filter_params.get('toBlock', 'latest'))
+        logs = self.chain.get_logs(filter_params.get('address'), filter_params.get('topics'), from_block, to_block)
+        error = self.profile.log_range_error(from_block, to_block, len(logs))
+        if error is not None:
+            raise RpcError('log_range', error)
+        return logs
+
+
+def format_stats(node):
+    ''' one-paragraph summary of what the node served '''
+    stats = node.stats
+    methods = ', '.join(f'{method} {count}' for method, count in node.methods.most_common())
+    errors = ', '.join(f'{key[6:]} {count}' for key, count in sorted(stats.items()) if key.startswith('error_'))
+    return (f'{stats["http_requests"]} HTTP requests ({stats["batches"]} batches), {stats["rpc_requests"]} RPC calls, '
+            f'{stats["bytes_in"] / 1e6:.2f} MB in, {stats["bytes_out"] / 1e6:.2f} MB out, '
+            f'{stats["rate_limited"]} rate limited\n    methods: {methods}\n    errors: {errors or "none"}')
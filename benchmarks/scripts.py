@@ -0,0 +1,29 @@
+''' helpers for loading the campaign scripts (which live in directories with spaces
+    and read their endpoints from the environment at import time) '''
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# placeholder endpoints so the scripts import without a .env; benchmarks that
+# talk to a node point these at a local server instead:
+PLACEHOLDER_ENV = {
+    'ALCHEMY_URL_ARB': 'http://127.0.0.1:8545',
+    'ALCHEMY_URL_ETH': 'http://127.0.0.1:8545',
+    'ALCHEMY_URL_POLY': 'http://127.0.0.1:8545',
+    'ALCHEMY_URL_OPT': 'http://127.0.0.1:8545',
+}
+
+
+def load_script(relative_path, name=None):
+    ''' imports a campaign script by path, e.g. load_script('USDR minters/USDR_minting.py') '''
+    for key, value in PLACEHOLDER_ENV.items():
+        os.environ.setdefault(key, value)
+    path = os.path.join(ROOT, relative_path)
+    name = name or os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
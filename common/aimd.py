@@ -0,0 +1,93 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+from common.metrics import METRICS, find_caller
+
+
+class AIMDPool:
+    ''' runs an async worker over a list of chunks with a concurrency limit that adapts
+        to the provider (additive increase, multiplicative decrease): the limit grows by
+        about one per round of fast successful requests and halves on errors or when a
+        chunk takes more than latency_factor times the fastest chunk seen so far (i.e.
+        the provider is queueing us). Failed chunks are retried with exponential backoff
+        (each retry is counted in METRICS as a retry of 'chunk' by the calling function). '''
+
+    def __init__(self, initial=4, minimum=1, maximum=64, latency_factor=3.0,
+                 max_retries=8, base_delay=0.5, max_delay=30.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.base_latency = None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.completed = 0
+        self.errors = 0
+        self.peak = initial
+        self._last_decrease = 0.0
+
+    def _increase(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.peak = max(self.peak, int(self.limit))
+
+    def _decrease(self):
+        # at most one decrease per chunk latency, so a burst of in-flight failures
+        # doesn't collapse the limit all the way down:
+        now = time.monotonic()
+        if now - self._last_decrease >= (self.base_latency or 0.0):
+            self.limit = max(self.minimum, self.limit / 2)
+            self._last_decrease = now
+
+    async def _attempt(self, worker, i, chunk, attempt):
+        if attempt > 0:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        start = time.monotonic()
+        try:
+            result = await worker(chunk)
+            return i, chunk, attempt, result, None, time.monotonic() - start
+        except Exception as e:
+            return i, chunk, attempt, None, e, time.monotonic() - start
+
+    async def run(self, worker, chunks, on_result=None):
+        ''' awaits worker(chunk) for every chunk and returns the results in chunk order.
+            on_result(chunk, result) is called as each chunk finishes. '''
+        caller = find_caller()
+        chunks = list(chunks)
+        results = [None] * len(chunks)
+        pending = deque((i, chunk, 0) for i, chunk in enumerate(chunks))
+        running = set()
+
+        while pending or running:
+            while pending and len(running) < int(self.limit):
+                i, chunk, attempt = pending.popleft()
+                running.add(asyncio.create_task(self._attempt(worker, i, chunk, attempt)))
+
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i, chunk, attempt, result, error, latency = task.result()
+                if error is None:
+                    results[i] = result
+                    self.completed += 1
+                    self.base_latency = latency if self.base_latency is None else min(self.base_latency, latency)
+                    if latency <= self.latency_factor * self.base_latency:
+                        self._increase()
+                    else:
+                        self._decrease()
+                    if on_result is not None:
+                        on_result(chunk, result)
+                else:
+                    self.errors += 1
+                    self._decrease()
+                    if attempt >= self.max_retries:
+                        for task in running:
+                            task.cancel()
+                        raise error
+                    METRICS.record_retry('chunk', caller)
+                    pending.append((i, chunk, attempt + 1))
+
+        print(f'{self.completed} chunks, {self.errors} errors retried, peak concurrency {self.peak}')
+        return results
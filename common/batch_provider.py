@@ -0,0 +1,130 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from web3 import HTTPProvider
+from web3._utils.encoding import Web3JsonEncoder
+
+from common.http import get_session
+from common.logs import is_transient
+from common.metrics import METRICS, calling, find_caller
+from common.ratelimit import limiter_for_url, request_cost, service_for_url
+
+
+BATCH_SIZE = 100        # max requests per JSON-RPC batch array
+FLUSH_INTERVAL = 0.01   # seconds to wait for a batch to fill up before sending it
+MAX_IN_FLIGHT = 4       # concurrent batch POSTs
+WORKERS = 64            # threads used by batch_map to keep the queue full
+MAX_RETRIES = 5         # retries of a rate limited or timed out batch (or batch item)
+
+
+class BatchHTTPProvider(HTTPProvider):
+    ''' HTTPProvider that queues requests from any number of threads and sends them
+        as JSON-RPC batch arrays. Every caller still gets back its own response
+        (result or error), so web3 handles per-item errors as usual. A batch that is
+        rate limited or times out as a whole, and items answered with a rate limit
+        error, are sent again with backoff before their callers see the error (and
+        charged to the endpoint's rate limit bucket again, as the middleware only
+        charged them once). '''
+
+    def __init__(self, endpoint_uri=None, request_kwargs=None, session=None,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_in_flight=MAX_IN_FLIGHT):
+        # shared keep-alive pool with compressed responses unless a session is given:
+        session = session or get_session()
+        super().__init__(endpoint_uri, request_kwargs=request_kwargs, session=session)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._session = session
+        self._ids = itertools.count()
+        self._queue = queue.Queue()
+        self._senders = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+    def make_request(self, method, params):
+        self._start_flusher()
+        request = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': next(self._ids)}
+        future = Future()
+        self._queue.put((request, future, find_caller()))
+        return future.result()
+
+    def _start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        pending = {request['id']: (request, future, caller) for request, future, caller in batch}
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(2 ** (attempt - 1))
+                service = service_for_url(self.endpoint_uri)
+                limiter_for_url(self.endpoint_uri).acquire(
+                    sum(request_cost(service, request['method']) for request, _, _ in pending.values()))
+                for request, _, caller in pending.values():
+                    METRICS.record_retry(request['method'], caller)
+            try:
+                responses = self._post([request for request, _, _ in pending.values()])
+            except Exception as e:
+                if is_transient(e) and attempt < MAX_RETRIES:
+                    continue
+                for _, future, _ in pending.values():
+                    future.set_exception(e)
+                return
+
+            retry = {}
+            for item in responses:
+                request_id = item.get('id')
+                if request_id not in pending:
+                    continue
+                error = item.get('error')
+                if error is not None and is_transient(ValueError(error)) and attempt < MAX_RETRIES:
+                    retry[request_id] = pending.pop(request_id)
+                else:
+                    pending.pop(request_id)[1].set_result(item)
+            for _, future, _ in pending.values():
+                future.set_exception(ValueError('no response for request in JSON-RPC batch'))
+            pending = retry
+            if not pending:
+                return
+
+    def _post(self, batch):
+        body = json.dumps(batch, cls=Web3JsonEncoder)
+        response = self._session.post(self.endpoint_uri, data=body, **self.get_request_kwargs())
+        response.raise_for_status()
+        responses = response.json()
+        if not isinstance(responses, list):
+            # whole batch rejected (e.g. batch too large or rate limited):
+            raise ValueError(responses.get('error', responses))
+        return responses
+
+
+def batch_map(fn, items, max_workers=WORKERS):
+    ''' runs fn over items from a thread pool so that the web3 calls inside fn
+        get queued up together and sent as batches; results are in item order '''
+    caller = find_caller()
+
+    def call(item):
+        with calling(caller):
+            return fn(item)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call, items))
@@ -0,0 +1,64 @@
+import datetime as dt
+
+from common.cache import KeyValueStore
+from common.log_cache import get_chain_id
+
+
+BLOCK_TIMESTAMPS = KeyValueStore('block_timestamps')   # 'chain_id:block' -> header timestamp
+BLOCKS_BY_TIME = KeyValueStore('blocks_by_timestamp')  # 'chain_id:timestamp' -> block
+
+
+def date_to_timestamp(snap_date):
+    ''' unix time of midnight UTC at the start of snap_date (a datetime.date) '''
+    return int(dt.datetime(snap_date.year, snap_date.month, snap_date.day, tzinfo=dt.timezone.utc).timestamp())
+
+
+def get_block_timestamp(w3, block_num, chain_id=None):
+    ''' header timestamp of block_num, from the on-disk cache when we've seen it before '''
+    key = f'{chain_id or get_chain_id(w3)}:{block_num}'
+    time_stamp = BLOCK_TIMESTAMPS.get(key)
+    if time_stamp is None:
+        time_stamp = w3.eth.get_block(block_num)['timestamp']
+        BLOCK_TIMESTAMPS.put(key, time_stamp)
+    return time_stamp
+
+
+def get_block_by_timestamp(w3, time_stamp):
+    ''' last block mined at or before time_stamp (what Etherscan's getblocknobytime
+        returns with closest=before), found on the node itself: interpolation steps
+        between the bracketing headers, falling back to bisection whenever an
+        interpolation step doesn't at least halve the bracket '''
+    time_stamp = int(time_stamp)
+    chain_id = get_chain_id(w3)
+    key = f'{chain_id}:{time_stamp}'
+    block_num = BLOCKS_BY_TIME.get(key)
+    if block_num is not None:
+        return block_num
+
+    latest = w3.eth.get_block('latest')
+    hi, hi_time = latest['number'], latest['timestamp']
+    if time_stamp >= hi_time:
+        return hi   # not final yet, so not cached
+    lo = 0
+    lo_time = get_block_timestamp(w3, lo, chain_id)
+    if time_stamp < lo_time:
+        raise ValueError(f'timestamp {time_stamp} is before the genesis block')
+
+    # invariant: lo_time <= time_stamp < hi_time
+    interpolate = True
+    while hi - lo > 1:
+        if interpolate:
+            guess = lo + (time_stamp - lo_time) * (hi - lo) // (hi_time - lo_time)
+        else:
+            guess = (lo + hi) // 2
+        guess = min(max(guess, lo + 1), hi - 1)
+        guess_time = get_block_timestamp(w3, guess, chain_id)
+        width = hi - lo
+        if guess_time <= time_stamp:
+            lo, lo_time = guess, guess_time
+        else:
+            hi, hi_time = guess, guess_time
+        interpolate = (hi - lo) <= width // 2
+
+    BLOCKS_BY_TIME.put(key, lo)
+    return lo
@@ -0,0 +1,51 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+# on-disk caches (logs, prices, block timestamps, ...) live here unless overridden:
+CACHE_DIR = os.environ.get('AIRDROP_CACHE_DIR',
+                           os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache'))
+
+
+def cache_path(name):
+    ''' path of a file in the cache dir (creating the dir if needed) '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, name)
+
+
+class KeyValueStore:
+    ''' small persistent key -> JSON value table (SQLite) in the cache dir, safe to
+        share between threads '''
+
+    def __init__(self, name, file_name='kv.sqlite'):
+        self.table = name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path(file_name), timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get_many(self, keys):
+        ''' returns {key: value} for the keys that are stored '''
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f'SELECT key, value FROM "{self.table}" WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+                found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def put_many(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany(f'INSERT OR REPLACE INTO "{self.table}" VALUES (?, ?)',
+                                   [(key, json.dumps(value)) for key, value in dict(items).items()])
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def put(self, key, value):
+        self.put_many({key: value})
@@ -0,0 +1,283 @@
+''' record/replay of every request the campaigns make, for audits and regression runs:
+
+        AIRDROP_CASSETTE=record python "USDR minters/USDR_minting.py"   # talks to the network, keeps everything
+        AIRDROP_CASSETTE=replay python "USDR minters/USDR_minting.py"   # no network at all
+
+    Interactions are stored zlib-compressed in SQLite (AIRDROP_CASSETTE_FILE, by default
+    cassette.sqlite in the cache dir), keyed by a hash of the canonical request: endpoint
+    without path or credentials, JSON-RPC method and params (ids dropped, hex lowercased),
+    or HTTP method, path and query without API keys. JSON-RPC batches are recorded and
+    replayed item by item, so a replay doesn't depend on how requests got batched.
+    eth_getLogs answers are also indexed by filter and block range, and a replayed range
+    that was fetched in different chunks is put together from the recorded ones. '''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from web3._utils.encoding import Web3JsonEncoder
+
+from common.cache import cache_path
+
+
+CASSETTE_MODE = os.environ.get('AIRDROP_CASSETTE')   # 'record', 'replay', or unset (off)
+CASSETTE_FILE = os.environ.get('AIRDROP_CASSETTE_FILE', 'cassette.sqlite')
+API_KEY_PARAMS = {'apikey', 'api_key', 'key', 'x_cg_pro_api_key', 'x_cg_demo_api_key'}
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}   # never recorded
+
+if CASSETTE_MODE not in (None, '', 'record', 'replay'):
+    raise ValueError(f'AIRDROP_CASSETTE must be record or replay, not {CASSETTE_MODE!r}')
+
+
+class CassetteMiss(Exception):
+    ''' a replayed request that was never recorded '''
+
+
+def replaying():
+    return CASSETTE_MODE == 'replay'
+
+
+def canonical(value):
+    ''' request params with hex strings lowercased (checksummed addresses, block tags) '''
+    if isinstance(value, str):
+        return value.lower() if value.startswith('0x') else value
+    if isinstance(value, dict):
+        return {key: canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def endpoint_of(url):
+    ''' scheme://host[:port] - RPC URLs carry their API key in the path '''
+    parsed = urlparse(url)
+    return f'{parsed.scheme}://{parsed.netloc.rsplit("@", 1)[-1]}'
+
+
+def rpc_key(endpoint, method, params):
+    return digest(['rpc', endpoint, method, canonical(params)])
+
+
+def http_key(method, url, body):
+    parsed = urlparse(url)
+    query = sorted((key, value) for key, value in parse_qsl(parsed.query) if key.lower() not in API_KEY_PARAMS)
+    body = body.decode('utf-8', 'surrogateescape') if isinstance(body, bytes) else body
+    return digest(['http', method, endpoint_of(url), parsed.path, urlencode(query), body or ''])
+
+
+def block_int(block):
+    return int(block, 16) if isinstance(block, str) and block.startswith('0x') else block
+
+
+class Cassette:
+    ''' the SQLite store behind the adapter and middleware, safe to share between threads '''
+
+    def __init__(self, path=None):
+        path = path or (CASSETTE_FILE if os.path.dirname(CASSETTE_FILE) else cache_path(CASSETTE_FILE))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS interactions (key TEXT PRIMARY KEY, request BLOB, response BLOB)')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS log_ranges (
+                                      filter TEXT, from_block INTEGER, to_block INTEGER, key TEXT,
+                                      PRIMARY KEY (filter, from_block, to_block))''')
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM interactions WHERE key=?', (key,)).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, request, response):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO interactions VALUES (?, ?, ?)',
+                               (key, zlib.compress(json.dumps(request).encode()),
+                                zlib.compress(json.dumps(response).encode())))
+
+    def get_rpc(self, endpoint, method, params):
+        ''' recorded response to a JSON-RPC request (without its id), or None '''
+        response = self.get(rpc_key(endpoint, method, params))
+        if response is None and method == 'eth_getLogs':
+            return self._assemble_logs(endpoint, params[0])
+        return response
+
+    def put_rpc(self, endpoint, method, params, response):
+        key = rpc_key(endpoint, method, params)
+        response = {name: value for name, value in response.items() if name != 'id'}
+        self.put(key, {'endpoint': endpoint, 'method': method, 'params': params}, response)
+        if method == 'eth_getLogs' and 'result' in response:
+            filter_params = params[0]
+            from_block, to_block = block_int(filter_params.get('fromBlock')), block_int(filter_params.get('toBlock'))
+            if isinstance(from_block, int) and isinstance(to_block, int):
+                with self._lock, self._conn:
+                    self._conn.execute('INSERT OR REPLACE INTO log_ranges VALUES (?, ?, ?, ?)',
+                                       (log_filter_key(endpoint, filter_params), from_block, to_block, key))
+
+    def _assemble_logs(self, endpoint, filter_params):
+        ''' eth_getLogs answer for a block range from recorded answers that cover it '''
+        from_block, to_block = block_int(filter_params.get('fromBlock')), block_int(filter_params.get('toBlock'))
+        if not isinstance(from_block, int) or not isinstance(to_block, int):
+            return None
+        with self._lock:
+            rows = self._conn.execute('''SELECT from_block, to_block, key FROM log_ranges
+                                         WHERE filter=? AND to_block>=? AND from_block<=? ORDER BY from_block''',
+                                      (log_filter_key(endpoint, filter_params), from_block, to_block)).fetchall()
+        keys, covered = [], from_block - 1
+        for start, end, key in rows:
+            if start > covered + 1:
+                break
+            if end > covered:
+                keys.append(key)
+                covered = end
+        if covered < to_block:
+            return None
+
+        logs = {}
+        for key in keys:
+            for log in self.get(key)['result']:
+                block = int(log['blockNumber'], 16)
+                if from_block <= block <= to_block:
+                    logs[(block, int(log['logIndex'], 16))] = log
+        return {'jsonrpc': '2.0', 'result': [logs[position] for position in sorted(logs)]}
+
+
+def log_filter_key(endpoint, filter_params):
+    return digest([endpoint, canonical(filter_params.get('address')), canonical(filter_params.get('topics'))])
+
+
+_CASSETTE = None
+_CASSETTE_LOCK = threading.Lock()
+
+
+def get_cassette():
+    global _CASSETTE
+    with _CASSETTE_LOCK:
+        if _CASSETTE is None:
+            _CASSETTE = Cassette()
+        return _CASSETTE
+
+
+def parse_rpc(body):
+    ''' JSON-RPC request (dict) or batch (list) in an HTTP body, or None '''
+    if not body:
+        return None
+    try:
+        request = json.loads(body)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(request, dict) and 'method' in request:
+        return request
+    if isinstance(request, list) and request and all(isinstance(item, dict) and 'method' in item for item in request):
+        return request
+    return None
+
+
+def build_response(request, status, content, content_type='application/json'):
+    response = requests.Response()
+    response.status_code = status
+    response._content = content
+    response.headers = CaseInsensitiveDict({'Content-Type': content_type})
+    response.encoding = 'utf-8'
+    response.url = request.url
+    response.request = request
+    response.reason = 'OK' if status < 400 else 'Replayed error'
+    return response
+
+
+class CassetteAdapter(HTTPAdapter):
+    ''' requests transport adapter that records every exchange (mode 'record') or
+        answers from the cassette without touching the network (mode 'replay') '''
+
+    def __init__(self, mode, cassette=None, **kwargs):
+        super().__init__(**kwargs)
+        self.mode = mode
+        self.cassette = cassette or get_cassette()
+
+    def send(self, request, **kwargs):
+        rpc = parse_rpc(request.body)
+        if rpc is not None:
+            return self._send_rpc(request, rpc, **kwargs)
+        return self._send_http(request, **kwargs)
+
+    def _send_rpc(self, request, rpc, **kwargs):
+        endpoint = endpoint_of(request.url)
+        items = rpc if isinstance(rpc, list) else [rpc]
+
+        if self.mode == 'replay':
+            responses = []
+            for item in items:
+                response = self.cassette.get_rpc(endpoint, item['method'], item.get('params', []))
+                if response is None:
+                    raise CassetteMiss(f'{item["method"]} {json.dumps(item.get("params"))[:200]} on {endpoint}')
+                responses.append(dict(response, id=item.get('id')))
+            body = responses if isinstance(rpc, list) else responses[0]
+            return build_response(request, 200, json.dumps(body).encode())
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 200:
+            try:
+                answers = response.json()
+            except ValueError:
+                return response
+            answers = answers if isinstance(answers, list) else [answers]
+            by_id = {answer.get('id'): answer for answer in answers if isinstance(answer, dict)}
+            for item in items:
+                answer = by_id.get(item.get('id'))
+                if answer is not None:
+                    self.cassette.put_rpc(endpoint, item['method'], item.get('params', []), answer)
+        return response
+
+    def _send_http(self, request, **kwargs):
+        key = http_key(request.method, request.url, request.body)
+        if self.mode == 'replay':
+            recorded = self.cassette.get(key)
+            if recorded is None:
+                raise CassetteMiss(f'{request.method} {endpoint_of(request.url)}{urlparse(request.url).path}')
+            return build_response(request, recorded['status'], recorded['body'].encode('utf-8', 'surrogateescape'),
+                                  recorded['content_type'])
+
+        response = super().send(request, **kwargs)
+        if response.status_code not in TRANSIENT_STATUS:
+            parsed = urlparse(request.url)
+            self.cassette.put(key, {'method': request.method, 'endpoint': endpoint_of(request.url), 'path': parsed.path},
+                              {'status': response.status_code,
+                               'content_type': response.headers.get('Content-Type', 'application/json'),
+                               'body': response.content.decode('utf-8', 'surrogateescape')})
+        return response
+
+
+def plain(value):
+    ''' JSON-ready copy of web3 values (HexBytes, AttributeDict, ...) '''
+    return json.loads(json.dumps(value, cls=Web3JsonEncoder))
+
+
+async def async_cassette_middleware(make_request, w3):
+    ''' AsyncWeb3 middleware doing the same for async providers (aiohttp has no
+        transport adapters). Add it last, so it's the outermost layer and a
+        replay skips the rate limiter as well. '''
+    if not CASSETTE_MODE:
+        return make_request
+    endpoint = endpoint_of(w3.provider.endpoint_uri)
+    cassette = get_cassette()
+
+    async def middleware(method, params):
+        if replaying():
+            response = cassette.get_rpc(endpoint, method, plain(params))
+            if response is None:
+                raise CassetteMiss(f'{method} {json.dumps(plain(params))[:200]} on {endpoint}')
+            return response
+        response = await make_request(method, params)
+        if 'error' in response or 'result' in response:
+            cassette.put_rpc(endpoint, method, plain(params), plain(dict(response)))
+        return response
+    return middleware
@@ -0,0 +1,70 @@
+import json
+import sqlite3
+import threading
+
+from common.cache import cache_path
+from common.log_cache import merge_ranges, missing_ranges
+
+
+class ScanCheckpoint:
+    ''' durable progress store for long scans over token ids or holders (SQLite, WAL).
+        Each finished chunk is committed in one transaction together with its partial
+        results - running totals per key and/or per-item records - so after a crash a
+        restart with the same scan_id (include the snapshot block in it) only redoes
+        the chunks that were in flight. '''
+
+    def __init__(self, scan_id, file_name='checkpoints.sqlite'):
+        self.scan_id = scan_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path(file_name), timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS ranges (scan TEXT, start INTEGER, end INTEGER)')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS totals (
+                                      scan TEXT, key TEXT, value TEXT, PRIMARY KEY (scan, key))''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS records (
+                                      scan TEXT, key TEXT, value TEXT, PRIMARY KEY (scan, key))''')
+
+    def done_ranges(self):
+        ''' set of (start, end) ranges committed so far '''
+        with self._lock:
+            rows = self._conn.execute('SELECT start, end FROM ranges WHERE scan=?', (self.scan_id,))
+            return set(rows)
+
+    def missing_ranges(self, start, end):
+        ''' parts of [start, end] not covered by any committed range, so a restart
+            with a different chunking never counts an item twice '''
+        return missing_ranges(start, end, merge_ranges(self.done_ranges()))
+
+    def totals(self):
+        ''' {key: int} running totals summed over all committed chunks '''
+        with self._lock:
+            rows = self._conn.execute('SELECT key, value FROM totals WHERE scan=?', (self.scan_id,))
+            return {key: int(value) for key, value in rows}
+
+    def records(self):
+        ''' {key: value} of all committed records '''
+        with self._lock:
+            rows = self._conn.execute('SELECT key, value FROM records WHERE scan=?', (self.scan_id,))
+            return {key: json.loads(value) for key, value in rows}
+
+    def commit(self, done=None, totals=None, records=None):
+        ''' atomically marks range done=(start, end) as finished, adds totals
+            (exact ints, stored as text) and stores records '''
+        with self._lock, self._conn:
+            if totals:
+                keys = [str(key) for key in totals]
+                current = {}
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    current.update(self._conn.execute(
+                        f'SELECT key, value FROM totals WHERE scan=? AND key IN ({",".join("?" * len(chunk))})',
+                        [self.scan_id] + chunk))
+                self._conn.executemany('INSERT OR REPLACE INTO totals VALUES (?, ?, ?)',
+                                       [(self.scan_id, str(key), str(int(current.get(str(key), 0)) + int(value)))
+                                        for key, value in totals.items()])
+            if records:
+                self._conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+                                       [(self.scan_id, str(key), json.dumps(value)) for key, value in records.items()])
+            if done is not None:
+                self._conn.execute('INSERT INTO ranges VALUES (?, ?, ?)', (self.scan_id,) + tuple(done))
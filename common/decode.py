@@ -0,0 +1,93 @@
+import re
+
+import numpy as np
+import pandas as pd
+from eth_utils import to_checksum_address
+from hexbytes import HexBytes
+from web3._utils.events import get_event_data
+
+
+STATIC_TYPE = re.compile(r'^(address|bool|u?int\d*|bytes\d+)$')
+META_COLUMNS = ['block_num', 'log_index', 'tx_hash']
+
+
+def arg_names(event_abi):
+    return [arg['name'] or f'_{i}' for i, arg in enumerate(event_abi['inputs'])]
+
+
+def to_words(chunks, n_words):
+    ''' list of equally sized byte strings -> (n, n_words, 32) uint8 array '''
+    return np.frombuffer(b''.join(chunks), dtype=np.uint8).reshape(len(chunks), n_words, 32)
+
+
+def decode_words(abi_type, words):
+    ''' decodes a column of 32-byte ABI words (n x 32 uint8 array) '''
+    if abi_type == 'address':
+        # checksum each distinct 20-byte slice only once:
+        unique, inverse = np.unique(words[:, 12:], axis=0, return_inverse=True)
+        addresses = np.array([to_checksum_address(row.tobytes()) for row in unique], dtype=object)
+        return addresses[inverse.ravel()]
+    if abi_type == 'bool':
+        return words[:, 31] != 0
+    if abi_type.startswith('uint'):
+        if not words[:, :24].any():
+            # everything fits in the low 8 bytes - convert in one pass, still exact Python ints:
+            return np.ascontiguousarray(words[:, 24:]).view('>u8').ravel().astype(object)
+        return np.array([int.from_bytes(row.tobytes(), 'big') for row in words], dtype=object)
+    if abi_type.startswith('int'):
+        return np.array([int.from_bytes(row.tobytes(), 'big', signed=True) for row in words], dtype=object)
+    size = int(abi_type[len('bytes'):])
+    return np.array([row[:size].tobytes() for row in words], dtype=object)
+
+
+def decode_logs_slow(w3, event_abi, logs):
+    ''' per-log get_event_data, for events with dynamic types '''
+    names = arg_names(event_abi)
+    columns = {name: [] for name in names + META_COLUMNS}
+    for log in logs:
+        evt = get_event_data(w3.codec, event_abi, log)
+        for name, arg in zip(names, event_abi['inputs']):
+            columns[name].append(evt['args'][arg['name']])
+        columns['block_num'].append(evt['blockNumber'])
+        columns['log_index'].append(evt['logIndex'])
+        columns['tx_hash'].append(evt['transactionHash'].hex())
+    return pd.DataFrame(columns)
+
+
+def decode_logs(w3, event_abi, logs):
+    ''' decodes a batch of raw logs of one event into a columnar table: one column per
+        event argument plus block_num, log_index and tx_hash. Indexed topics and static
+        data words are decoded column-wise with numpy (addresses as checksummed strings,
+        integers as exact Python ints); events with dynamic types fall back to get_event_data. '''
+    logs = list(logs)
+    inputs = event_abi['inputs']
+    if len(logs) == 0:
+        return pd.DataFrame({name: [] for name in arg_names(event_abi) + META_COLUMNS})
+    if any(not STATIC_TYPE.match(arg['type']) for arg in inputs):
+        return decode_logs_slow(w3, event_abi, logs)
+
+    indexed = [arg for arg in inputs if arg['indexed']]
+    not_indexed = [arg for arg in inputs if not arg['indexed']]
+    topic_offset = 0 if event_abi.get('anonymous') else 1
+
+    datas = [HexBytes(log['data']) for log in logs]
+    if any(len(data) != 32 * len(not_indexed) for data in datas):
+        return decode_logs_slow(w3, event_abi, logs)
+    topics = [b''.join(log['topics'][topic_offset:topic_offset + len(indexed)]) for log in logs]
+    topic_words = to_words(topics, len(indexed))
+    data_words = to_words(datas, len(not_indexed))
+
+    columns = {}
+    topic_i = data_i = 0
+    for name, arg in zip(arg_names(event_abi), inputs):
+        if arg['indexed']:
+            columns[name] = decode_words(arg['type'], topic_words[:, topic_i])
+            topic_i += 1
+        else:
+            columns[name] = decode_words(arg['type'], data_words[:, data_i])
+            data_i += 1
+
+    columns['block_num'] = np.array([log['blockNumber'] for log in logs], dtype=np.int64)
+    columns['log_index'] = np.array([log['logIndex'] for log in logs], dtype=np.int64)
+    columns['tx_hash'] = [HexBytes(log['transactionHash']).hex() for log in logs]
+    return pd.DataFrame(columns)
@@ -0,0 +1,13 @@
+import pandas as pd
+
+
+def build_frame(index, columns, index_name=None, dtypes=None):
+    ''' builds a DataFrame in one go from an index list and a dict of column lists,
+        instead of growing it one df.loc[key] = ... at a time. Repeated index values
+        keep the last row, the same as repeated df.loc assignments did. '''
+    df = pd.DataFrame(columns, index=pd.Index(index, name=index_name))
+    if dtypes:
+        df = df.astype(dtypes)
+    if df.index.has_duplicates:
+        df = df[~df.index.duplicated(keep='last')]
+    return df
@@ -0,0 +1,52 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.cassette import CASSETTE_MODE, CassetteAdapter
+from common.metrics import aiohttp_trace_config, response_hook
+
+try:
+    import brotli  # noqa: F401 (urllib3 and aiohttp decode br responses when it's installed)
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+POOL_CONNECTIONS = 16   # hosts with a pool of their own
+POOL_MAXSIZE = 64       # keep-alive connections per host: the widest pool (batch_map WORKERS, AIMDPool maximum)
+DNS_CACHE_TTL = 300     # seconds, aiohttp only (requests relies on the OS resolver)
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(pool_maxsize=POOL_MAXSIZE):
+    ''' process-wide requests session with persistent connection pools per host and
+        compressed responses; share it between clients so TLS connections get reused.
+        Idempotent requests (GET) are retried on 502/503/504. Every exchange is
+        recorded in common.metrics, and in the cassette when AIRDROP_CASSETTE is set. '''
+    with _SESSIONS_LOCK:
+        if pool_maxsize not in _SESSIONS:
+            session = requests.Session()
+            adapter_kwargs = dict(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize,
+                                  max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]))
+            if CASSETTE_MODE:
+                adapter = CassetteAdapter(CASSETTE_MODE, **adapter_kwargs)
+            else:
+                adapter = HTTPAdapter(**adapter_kwargs)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+            session.hooks['response'].append(response_hook)
+            _SESSIONS[pool_maxsize] = session
+        return _SESSIONS[pool_maxsize]
+
+
+def make_async_session(limit=POOL_MAXSIZE):
+    ''' aiohttp session for AsyncHTTPProvider with a pooled keep-alive connector and
+        DNS cache. Must be created (and closed) inside the running event loop. '''
+    import aiohttp
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit, ttl_dns_cache=DNS_CACHE_TTL)
+    return aiohttp.ClientSession(connector=connector, headers={'Accept-Encoding': ACCEPT_ENCODING},
+                                 trace_configs=[aiohttp_trace_config()])
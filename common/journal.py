@@ -0,0 +1,52 @@
+import json
+import os
+
+
+class Journal:
+    ''' append-only JSON Lines journal: records are appended as they are produced and a
+        progress marker closes each batch (flushed and fsynced together). On open the
+        journal is replayed up to the last marker; anything after it (a batch that was
+        cut off by a crash, or a half-written line) is truncated away. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records, self.progress, offset = self._replay()
+        self._file = open(path, 'ab')
+        self._file.truncate(offset)
+
+    def _replay(self):
+        records, progress, offset = [], None, 0
+        if not os.path.exists(self.path):
+            return records, progress, offset
+
+        pending = []
+        position = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                position += len(line)
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if 'progress' in entry:
+                    records.extend(pending)
+                    pending = []
+                    progress = entry['progress']
+                    offset = position
+                else:
+                    pending.append(entry['record'])
+        return records, progress, offset
+
+    def append(self, record):
+        self._file.write(json.dumps({'record': record}).encode() + b'\n')
+
+    def mark(self, progress):
+        ''' closes the current batch: everything appended so far survives a crash '''
+        self._file.write(json.dumps({'progress': progress}).encode() + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,53 @@
+from collections import defaultdict
+
+
+NULL_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+class TransferLedger:
+    ''' replays ERC20 Transfer events into exact (integer) balances per holder.
+        A transfer from the null address is a mint and credits the receiver (even
+        the null address itself, e.g. MINIMUM_LIQUIDITY in Uniswap-style pairs);
+        any other transfer to the null address is a burn and credits nobody. '''
+
+    def __init__(self):
+        self.transfers = []
+
+    def add(self, block_num, log_index, sender, receiver, amount):
+        self.transfers.append((block_num, log_index, sender, receiver, amount))
+
+    def add_events(self, events, sender='from', receiver='to', amount='amount'):
+        ''' adds decoded events (as returned by get_event_data) '''
+        for evt in events:
+            args = evt['args']
+            self.add(evt['blockNumber'], evt['logIndex'], args[sender], args[receiver], args[amount])
+
+    def add_table(self, df, sender='from', receiver='to', amount='amount'):
+        ''' adds transfers from a decoded log table (see common.decode.decode_logs) '''
+        self.transfers.extend(zip(df.block_num, df.log_index, df[sender], df[receiver], df[amount]))
+
+    def replay(self, block_num=None):
+        ''' returns (balances, total_supply) as of the end of block_num (default: all events) '''
+        balances = defaultdict(int)
+        total_supply = 0
+        for evt_block_num, _, sender, receiver, amount in sorted(self.transfers, key=lambda t: t[:2]):
+            if block_num is not None and evt_block_num > block_num:
+                break
+            if sender == NULL_ADDRESS:
+                total_supply += amount
+            else:
+                balances[sender] -= amount
+                if balances[sender] < 0:
+                    raise ValueError(f'negative balance for {sender} at block {evt_block_num}')
+            if receiver == NULL_ADDRESS and sender != NULL_ADDRESS:
+                total_supply -= amount
+            else:
+                balances[receiver] += amount
+        return dict(balances), total_supply
+
+    def balances(self, block_num=None):
+        ''' balance of every address that has held the token, including those now at zero '''
+        return self.replay(block_num)[0]
+
+    def total_supply(self, block_num=None):
+        return self.replay(block_num)[1]
@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import threading
+
+from hexbytes import HexBytes
+from web3._utils.encoding import Web3JsonEncoder
+from web3.datastructures import AttributeDict
+
+from common.cache import cache_path
+from common.logs import MAX_WORKERS, get_logs, provider_key, to_block_int
+
+
+LOG_CACHE_FILE = 'logs.sqlite'
+HEX_FIELDS = ('data', 'transactionHash', 'blockHash')
+
+_CHAIN_IDS = {}
+_WRITE_LOCK = threading.Lock()
+
+
+def connect():
+    conn = sqlite3.connect(cache_path(LOG_CACHE_FILE), timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS coverage (
+                        chain_id INTEGER, address TEXT, topic0 TEXT, from_block INTEGER, to_block INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS logs (
+                        chain_id INTEGER, address TEXT, topic0 TEXT, block_number INTEGER, log_index INTEGER,
+                        log TEXT, PRIMARY KEY (chain_id, address, topic0, block_number, log_index))''')
+    return conn
+
+
+def get_chain_id(w3):
+    key = provider_key(w3)
+    if key not in _CHAIN_IDS:
+        _CHAIN_IDS[key] = w3.eth.chain_id
+    return _CHAIN_IDS[key]
+
+
+def encode_log(log):
+    return json.dumps(dict(log), cls=Web3JsonEncoder)
+
+
+def decode_log(text):
+    log = json.loads(text)
+    log['topics'] = [HexBytes(topic) for topic in log['topics']]
+    for field in HEX_FIELDS:
+        if field in log:
+            log[field] = HexBytes(log[field])
+    return AttributeDict(log)
+
+
+def merge_ranges(ranges):
+    ''' merges overlapping or adjacent (from, to) block ranges '''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_ranges(from_block, to_block, covered):
+    ''' parts of [from_block, to_block] not in the (merged) covered ranges '''
+    missing = []
+    start = from_block
+    for cover_start, cover_end in covered:
+        if cover_end < start:
+            continue
+        if cover_start > to_block:
+            break
+        if cover_start > start:
+            missing.append((start, cover_start - 1))
+        start = max(start, cover_end + 1)
+    if start <= to_block:
+        missing.append((start, to_block))
+    return missing
+
+
+def _store(conn, key, start, end, logs):
+    ''' stores logs for [start, end] and marks the range as covered in one transaction '''
+    chain_id, address, topic0 = key
+    with _WRITE_LOCK, conn:
+        conn.executemany('INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?)',
+                         [(chain_id, address, topic0, log['blockNumber'], log['logIndex'], encode_log(log))
+                          for log in logs])
+        ranges = conn.execute('SELECT from_block, to_block FROM coverage WHERE chain_id=? AND address=? AND topic0=?',
+                              key).fetchall()
+        conn.execute('DELETE FROM coverage WHERE chain_id=? AND address=? AND topic0=?', key)
+        conn.executemany('INSERT INTO coverage VALUES (?, ?, ?, ?, ?)',
+                         [key + r for r in merge_ranges(ranges + [(start, end)])])
+
+
+def _matches(log, topics):
+    ''' applies the topic filters past topic0 locally (None matches anything) '''
+    for i, topic in enumerate(topics):
+        if i == 0 or topic is None:
+            continue
+        options = topic if isinstance(topic, list) else [topic]
+        if i >= len(log['topics']) or HexBytes(log['topics'][i]) not in [HexBytes(o) for o in options]:
+            return False
+    return True
+
+
+def get_cached_logs(w3, filter_params, max_workers=MAX_WORKERS):
+    ''' same as common.logs.get_logs, but backed by an on-disk store keyed by
+        (chain id, address, topic0) that remembers which block ranges it holds:
+        only blocks that are not in the cache yet are requested from the node.
+        Only meant for historical (finalized) block ranges. '''
+    address = filter_params.get('address')
+    topics = filter_params.get('topics') or []
+    if not isinstance(address, str) or len(topics) == 0 or not isinstance(topics[0], str):
+        return get_logs(w3, filter_params, max_workers=max_workers)
+
+    key = (get_chain_id(w3), address.lower(), topics[0].lower())
+    from_block = to_block_int(filter_params['fromBlock'])
+    to_block = to_block_int(filter_params['toBlock'])
+
+    conn = connect()
+    try:
+        covered = conn.execute('SELECT from_block, to_block FROM coverage WHERE chain_id=? AND address=? AND topic0=?',
+                               key).fetchall()
+        for start, end in missing_ranges(from_block, to_block, merge_ranges(covered)):
+            params = dict(filter_params, topics=[topics[0]], fromBlock=start, toBlock=end)
+            _store(conn, key, start, end, get_logs(w3, params, max_workers=max_workers))
+
+        rows = conn.execute('''SELECT log FROM logs WHERE chain_id=? AND address=? AND topic0=?
+                               AND block_number BETWEEN ? AND ? ORDER BY block_number, log_index''',
+                            key + (from_block, to_block)).fetchall()
+    finally:
+        conn.close()
+
+    logs = [decode_log(text) for text, in rows]
+    return [log for log in logs if _matches(log, topics)]
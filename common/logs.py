@@ -0,0 +1,152 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from common.metrics import METRICS, calling, find_caller
+
+
+MAX_WORKERS = 8         # concurrent eth_getLogs requests
+MAX_RETRIES = 5         # retries of a rate limited or timed out request before giving up
+MAX_SPLIT_DEPTH = 32    # bisections of a range the provider rejects as too large
+GROWTH = 16             # a learned limit grows by 1/GROWTH of its size after it worked again
+
+# provider answers to a block range (or result set) that is too large:
+RANGE_ERRORS = ('block range', 'range is too large', 'range too large', 'response size',
+                'more than 10000 results', 'query returned more than', 'too many results')
+# provider answers worth retrying as they are:
+TRANSIENT_ERRORS = ('rate limit', 'compute units', 'too many requests', 'timeout', 'timed out',
+                    'header not found', 'try again')
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+# (limit, step) per (endpoint, address, topic0) - the block range eth_getLogs was
+# last seen to accept for a filter, and how much it grows by after each call at it:
+_RANGE_LIMITS = {}
+_RANGE_LOCK = threading.Lock()
+
+
+def to_block_int(block):
+    if isinstance(block, str):
+        return int(block, 0)
+    return int(block)
+
+
+def provider_key(w3):
+    return getattr(w3.provider, 'endpoint_uri', None) or repr(w3.provider)
+
+
+def filter_key(w3, filter_params):
+    ''' the range limit depends on how dense the matching logs are, so it's learned per filter '''
+    address = filter_params.get('address')
+    if isinstance(address, (list, tuple)):
+        address = tuple(sorted(str(item).lower() for item in address))
+    elif address is not None:
+        address = str(address).lower()
+    topics = filter_params.get('topics') or [None]
+    topic0 = tuple(topics[0]) if isinstance(topics[0], (list, tuple)) else topics[0]
+    return provider_key(w3), address, topic0
+
+
+def split_range(start_block, end_block, span):
+    ''' splits [start_block, end_block] into consecutive chunks of at most span blocks '''
+    return [(start, min(start + span - 1, end_block)) for start in range(start_block, end_block + 1, span)]
+
+
+def is_range_error(e):
+    ''' whether eth_getLogs failed because the block range or result set is too large '''
+    message = str(e).lower()
+    return isinstance(e, ValueError) and any(text in message for text in RANGE_ERRORS)
+
+
+def is_transient(e):
+    ''' whether eth_getLogs failed on rate limits, timeouts or server errors '''
+    if isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, TimeoutError)):
+        return True
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    message = str(e).lower()
+    return any(text in message for text in TRANSIENT_ERRORS)
+
+
+def range_limit(key):
+    with _RANGE_LOCK:
+        limit = _RANGE_LIMITS.get(key)
+        return limit and limit[0]
+
+
+def _record_success(key, span):
+    ''' additive increase: a range at the current limit worked, so try a bit more next time '''
+    with _RANGE_LOCK:
+        if key in _RANGE_LIMITS:
+            limit, step = _RANGE_LIMITS[key]
+            if span >= limit:
+                _RANGE_LIMITS[key] = (limit + step, step)
+
+
+def _record_failure(key, span):
+    ''' multiplicative decrease, on range errors only; returns the new limit '''
+    with _RANGE_LOCK:
+        limit, step = _RANGE_LIMITS.get(key, (None, None))
+        if limit is None or limit >= span:
+            limit = max(span // 2, 1)
+            step = max(limit // GROWTH, 1)
+            _RANGE_LIMITS[key] = (limit, step)
+        return limit
+
+
+def get_logs(w3, filter_params, max_workers=MAX_WORKERS, max_retries=MAX_RETRIES):
+    ''' eth_getLogs over [fromBlock, toBlock] of filter_params, split into chunks that
+        are fetched in parallel. A chunk the provider rejects as too large is bisected
+        (and the range it accepts for this filter is remembered for later calls), a rate
+        limited or timed out one is retried as it is with backoff, and any other error
+        is raised. Logs are returned in (blockNumber, logIndex) order. '''
+    from_block = to_block_int(filter_params['fromBlock'])
+    to_block = to_block_int(filter_params['toBlock'])
+    if to_block < from_block:
+        return []
+    key = filter_key(w3, filter_params)
+    caller = find_caller()
+
+    def fetch(start, end, attempt):
+        if attempt > 0:
+            time.sleep(2 ** (attempt - 1))
+        params = dict(filter_params, fromBlock=start, toBlock=end)
+        with calling(caller):
+            return w3.eth.get_logs(params)
+
+    # if we don't know the provider's limit for this filter yet, probe with the whole range:
+    span = range_limit(key) or to_block - from_block + 1
+
+    logs = []
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit(start, end, attempt=0, depth=0):
+            jobs[executor.submit(fetch, start, end, attempt)] = (start, end, attempt, depth)
+
+        for start, end in split_range(from_block, to_block, span):
+            submit(start, end)
+
+        while jobs:
+            done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end, attempt, depth = jobs.pop(future)
+                try:
+                    logs.extend(future.result())
+                    _record_success(key, end - start + 1)
+                except Exception as e:
+                    if is_range_error(e) and end > start and depth < MAX_SPLIT_DEPTH:
+                        # bisect, or use the (smaller) limit learned meanwhile:
+                        span = min(_record_failure(key, end - start + 1), (end - start + 1) // 2 + 1)
+                        for chunk_start, chunk_end in split_range(start, end, span):
+                            submit(chunk_start, chunk_end, depth=depth + 1)
+                        METRICS.record_retry('eth_getLogs', caller)
+                    elif is_transient(e) and attempt < max_retries:
+                        submit(start, end, attempt + 1, depth)
+                        METRICS.record_retry('eth_getLogs', caller)
+                    else:
+                        raise
+
+    logs.sort(key=lambda log: (log['blockNumber'], log['logIndex']))
+    return logs
@@ -0,0 +1,310 @@
+import bisect
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+# latency histogram bucket upper bounds, in milliseconds (the last bucket is open-ended):
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+COMMON_DIR = os.path.dirname(os.path.abspath(__file__))
+# frames in these modules are plumbing, never "the caller" of a request:
+PLUMBING_FILES = {os.path.join(COMMON_DIR, name) for name in
+                  ('metrics.py', 'ratelimit.py', 'batch_provider.py', 'http.py', 'cassette.py')}
+PLUMBING_PACKAGES = ('web3', 'eth_', 'hexbytes', 'toolz', 'requests', 'urllib3', 'aiohttp', 'concurrent',
+                     'threading', 'asyncio', 'contextlib', 'functools')
+
+# caller of the work a helper hands to its worker threads (see calling):
+_CALLER = contextvars.ContextVar('caller', default=None)
+
+
+class Histogram:
+    ''' fixed-bucket latency histogram; percentiles are reported as bucket upper bounds '''
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, pct):
+        n = sum(self.counts)
+        if n == 0:
+            return 0.0
+        rank = pct / 100 * n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'buckets_ms': LATENCY_BUCKETS_MS, 'counts': self.counts, 'total_ms': round(self.total, 3),
+                'max_ms': round(self.max, 3)}
+
+
+class Stats:
+    ''' counters and latency of one (method, caller) or (host, method) cell '''
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'retries': self.retries, 'bytes': self.bytes,
+                'mean_ms': round(self.latency.total / self.count, 3) if self.count else 0.0,
+                'p50_ms': self.latency.percentile(50), 'p95_ms': self.latency.percentile(95),
+                'p99_ms': self.latency.percentile(99), 'latency': self.latency.to_dict()}
+
+
+class Metrics:
+    ''' process-wide request metrics, safe to update from threads and asyncio tasks:
+        JSON-RPC calls by (method, calling function) as seen by web3, and HTTP
+        exchanges by (host, method) as seen on the wire '''
+
+    def __init__(self):
+        self.started = time.time()
+        self._rpc = defaultdict(Stats)
+        self._http = defaultdict(Stats)
+        self._lock = threading.Lock()
+
+    def record_rpc(self, method, caller, seconds, error=False):
+        with self._lock:
+            stats = self._rpc[(method, caller)]
+            stats.count += 1
+            stats.errors += bool(error)
+            stats.latency.add(seconds * 1000)
+
+    def record_retry(self, method, caller=None):
+        with self._lock:
+            self._rpc[(method, caller or find_caller())].retries += 1
+
+    def record_http(self, host, method, seconds, n_bytes, error=False, retries=0):
+        with self._lock:
+            stats = self._http[(host, method)]
+            stats.count += 1
+            stats.errors += bool(error)
+            stats.retries += retries
+            stats.bytes += n_bytes
+            stats.latency.add(seconds * 1000)
+
+    def reset(self):
+        with self._lock:
+            self._rpc.clear()
+            self._http.clear()
+            self.started = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'rpc': [dict(method=method, caller=caller, **stats.to_dict())
+                        for (method, caller), stats in sorted(self._rpc.items())],
+                'http': [dict(host=host, method=method, **stats.to_dict())
+                         for (host, method), stats in sorted(self._http.items())]}
+
+    def report(self):
+        ''' per-method totals (with the top callers under each) and per-host traffic '''
+        data = self.to_dict()
+        methods = defaultdict(list)
+        for row in data['rpc']:
+            methods[row['method']].append(row)
+
+        lines = [f'{"JSON-RPC method / caller":<48} {"calls":>8} {"errors":>7} {"retries":>7} '
+                 f'{"total s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}']
+        totals = {method: merge(rows) for method, rows in methods.items()}
+        for method in sorted(totals, key=lambda method: -totals[method].latency.total):
+            lines.append(format_row(method, totals[method]))
+            callers = sorted(methods[method], key=lambda row: -row['latency']['total_ms'])
+            for row in callers[:5]:
+                lines.append(format_row(f'  {row["caller"]}', merge([row])))
+        if data['http']:
+            lines.append(f'{"HTTP host / method":<48} {"requests":>8} {"errors":>7} {"retries":>7} '
+                         f'{"MB":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+            for row in data['http']:
+                stats = merge([row])
+                lines.append(f'{row["host"] + " " + row["method"]:<48} {stats.count:>8} {stats.errors:>7} '
+                             f'{stats.retries:>7} {stats.bytes / 1e6:>9.2f} {stats.latency.percentile(50):>8g} '
+                             f'{stats.latency.percentile(95):>8g} {stats.latency.percentile(99):>8g}')
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        ''' writes the metrics as JSON (see to_dict) '''
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+
+def merge(rows):
+    ''' one Stats out of to_dict() rows '''
+    stats = Stats()
+    for row in rows:
+        stats.count += row['count']
+        stats.errors += row['errors']
+        stats.retries += row['retries']
+        stats.bytes += row['bytes']
+        stats.latency.counts = [a + b for a, b in zip(stats.latency.counts, row['latency']['counts'])]
+        stats.latency.total += row['latency']['total_ms']
+        stats.latency.max = max(stats.latency.max, row['latency']['max_ms'])
+    return stats
+
+
+def format_row(label, stats):
+    return (f'{label:<48} {stats.count:>8} {stats.errors:>7} {stats.retries:>7} {stats.latency.total / 1000:>9.1f} '
+            f'{stats.latency.percentile(50):>8g} {stats.latency.percentile(95):>8g} {stats.latency.percentile(99):>8g}')
+
+
+METRICS = Metrics()
+
+
+def is_plumbing(filename):
+    if filename in PLUMBING_FILES:
+        return True
+    parts = filename.replace('\\', '/').split('/')
+    return any(part.startswith(PLUMBING_PACKAGES) for part in parts[-4:-1]) or \
+        os.path.basename(filename).startswith(PLUMBING_PACKAGES)
+
+
+def find_caller(depth=1):
+    ''' 'module.function' of the code that made the request: the nearest campaign
+        script frame, else the caller handed down by calling(), else the nearest
+        common helper '''
+    frame = sys._getframe(depth)
+    helper = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not is_plumbing(filename):
+            name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name).split('.<locals>')[0]
+            caller = f'{os.path.splitext(os.path.basename(filename))[0]}.{name}'
+            if not filename.startswith(COMMON_DIR):
+                return caller
+            helper = helper or caller
+        frame = frame.f_back
+    return _CALLER.get() or helper or '?'
+
+
+@contextmanager
+def calling(caller):
+    ''' attributes requests made in this block (e.g. in a worker thread) to caller '''
+    token = _CALLER.set(caller)
+    try:
+        yield
+    finally:
+        _CALLER.reset(token)
+
+
+def is_error(response):
+    return isinstance(response, dict) and response.get('error') is not None
+
+
+def metrics_middleware(make_request, w3):
+    ''' web3 middleware timing every JSON-RPC request by method and calling function.
+        Add it before rate_limit_middleware so it sits inside it and time spent
+        waiting for the rate limiter isn't counted as request latency. '''
+    def middleware(method, params):
+        caller = find_caller()
+        start = time.perf_counter()
+        try:
+            response = make_request(method, params)
+        except Exception:
+            METRICS.record_rpc(method, caller, time.perf_counter() - start, error=True)
+            raise
+        METRICS.record_rpc(method, caller, time.perf_counter() - start, error=is_error(response))
+        return response
+    return middleware
+
+
+async def async_metrics_middleware(make_request, w3):
+    ''' AsyncWeb3 version of metrics_middleware '''
+    async def middleware(method, params):
+        caller = find_caller()
+        start = time.perf_counter()
+        try:
+            response = await make_request(method, params)
+        except Exception:
+            METRICS.record_rpc(method, caller, time.perf_counter() - start, error=True)
+            raise
+        METRICS.record_rpc(method, caller, time.perf_counter() - start, error=is_error(response))
+        return response
+    return middleware
+
+
+def request_method(body):
+    ''' JSON-RPC method of a request body; batches are 'batch <method>' if all items
+        share a method, else just 'batch' '''
+    if not body:
+        return None
+    try:
+        request = json.loads(body)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(request, list):
+        methods = {item.get('method') for item in request if isinstance(item, dict)}
+        return f'batch {methods.pop()}' if len(methods) == 1 else 'batch'
+    return request.get('method') if isinstance(request, dict) else None
+
+
+def response_hook(response, *args, **kwargs):
+    ''' requests response hook: one HTTP exchange (bytes as received, before decompression) '''
+    request = response.request
+    method = request_method(request.body) or f'{request.method} {urlparse(request.url).path}'
+    retries = getattr(response.raw, 'retries', None)
+    n_bytes = int(response.headers.get('Content-Length') or len(response.content))
+    METRICS.record_http(urlparse(request.url).hostname, method, response.elapsed.total_seconds(), n_bytes,
+                        error=response.status_code >= 400,
+                        retries=len(retries.history) if retries is not None else 0)
+
+
+def aiohttp_trace_config():
+    ''' aiohttp TraceConfig recording every exchange of a ClientSession '''
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+        context.method = f'{params.method} {params.url.path}'
+        context.bytes = 0
+
+    async def on_request_chunk_sent(session, context, params):
+        context.method = request_method(params.chunk) or context.method
+
+    async def on_response_chunk_received(session, context, params):
+        context.bytes += len(params.chunk)
+
+    async def on_request_end(session, context, params):
+        METRICS.record_http(params.url.host, context.method, time.perf_counter() - context.start,
+                            int(params.response.headers.get('Content-Length') or context.bytes),
+                            error=params.response.status >= 400)
+
+    async def on_request_exception(session, context, params):
+        METRICS.record_http(params.url.host, context.method, time.perf_counter() - context.start,
+                            context.bytes, error=True)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+def report_metrics():
+    return METRICS.report()
+
+
+def dump_metrics(path):
+    METRICS.dump(path)
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+
+from common.metrics import calling, find_caller
+
+
+MULTICALL3 = '0xcA11bde05977b3631167028862bE2a173976CA11'   # same address on every chain
+MULTICALL_BATCH_SIZE = 500
+
+MULTICALL3_ABI = [
+    {
+        'inputs': [
+            {
+                'components': [
+                    {
+                        'internalType': 'address',
+                        'name': 'target',
+                        'type': 'address'},
+                    {
+                        'internalType': 'bool',
+                        'name': 'allowFailure',
+                        'type': 'bool'},
+                    {
+                        'internalType': 'bytes',
+                        'name': 'callData',
+                        'type': 'bytes'}],
+                'internalType': 'struct Multicall3.Call3[]',
+                'name': 'calls',
+                'type': 'tuple[]'}],
+        'name': 'aggregate3',
+        'outputs': [
+            {
+                'components': [
+                    {
+                        'internalType': 'bool',
+                        'name': 'success',
+                        'type': 'bool'},
+                    {
+                        'internalType': 'bytes',
+                        'name': 'returnData',
+                        'type': 'bytes'}],
+                'internalType': 'struct Multicall3.Result[]',
+                'name': 'returnData',
+                'type': 'tuple[]'}],
+        'stateMutability': 'payable',
+        'type': 'function'}]
+
+
+def decode_result(w3, fn, success, return_data, allow_failure):
+    ''' decodes the raw return data of one sub-call the same way ContractFunction.call() would '''
+    if success and len(return_data) > 0:
+        output_types = get_abi_output_types(fn.abi)
+        decoded = w3.codec.decode(output_types, return_data)
+        normalized = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, decoded)
+        if len(normalized) == 1:
+            return normalized[0]
+        return list(normalized)
+
+    if allow_failure:
+        return None
+    raise ValueError(f'multicall: {fn.fn_name} on {fn.address} failed')
+
+
+def multicall(w3, calls, block_num, batch_size=MULTICALL_BATCH_SIZE, allow_failure=False,
+              max_workers=1):
+    ''' runs a list of contract function calls (e.g. contract.functions.balanceOf(owner))
+        through Multicall3 aggregate3 at block_num, batch_size calls per eth_call.
+        Returns decoded results in the same order as calls; if allow_failure is set
+        failed calls come back as None instead of reverting the whole batch.
+        Batches can be sent from max_workers threads (rate limits are applied by the
+        provider's middleware). '''
+    calls = list(calls)
+    contract = w3.eth.contract(MULTICALL3, abi=MULTICALL3_ABI)
+    caller = find_caller()
+
+    def run_batch(batch):
+        call_data = [(fn.address, allow_failure, fn._encode_transaction_data()) for fn in batch]
+        with calling(caller):
+            responses = contract.functions.aggregate3(call_data).call(block_identifier=block_num)
+        return [decode_result(w3, fn, success, return_data, allow_failure)
+                for fn, (success, return_data) in zip(batch, responses)]
+
+    batches = [calls[start:start + batch_size] for start in range(0, len(calls), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [result for batch_results in executor.map(run_batch, batches) for result in batch_results]
@@ -0,0 +1,97 @@
+import datetime as dt
+import json
+import os
+
+import pandas as pd
+
+from common.cache import KeyValueStore
+from common.http import get_session
+from common.ratelimit import get_limiter
+
+
+# JSON file with {'coins': {address: {'id', 'symbol'}}, 'prices': {coin_id: {'dd-mm-YYYY': usd}}};
+# when set, prices come from it and nothing is sent to CoinGecko:
+PRICE_FIXTURE = os.environ.get('AIRDROP_PRICE_FIXTURE')
+
+
+class PriceService:
+    ''' CoinGecko USD prices for token contracts on one platform (e.g. 'arbitrum-one').
+        Contract -> coin id comes from a single coins/list call (with platforms) and is
+        kept on disk, as is every (coin id, date) -> price, so a repeated snapshot for
+        the same date needs no network. Unlisted tokens are only remembered for the life
+        of the service, so one that gets listed later is picked up by the next run. '''
+
+    def __init__(self, platform, fixture=None):
+        self.platform = platform
+        fixture = fixture or PRICE_FIXTURE
+        self.fixture = None
+        if fixture:
+            with open(fixture) as file:
+                self.fixture = json.load(file)
+        self._coins = KeyValueStore('coingecko_coins')
+        self._prices = KeyValueStore('coingecko_prices')
+        self._unlisted = set()
+        self._limiter = get_limiter('coingecko')
+        self._cg = None
+
+    @property
+    def cg(self):
+        if self._cg is None:
+            from pycoingecko import CoinGeckoAPI
+            self._cg = CoinGeckoAPI()
+            self._cg.session = get_session()
+        return self._cg
+
+    def resolve(self, tokens):
+        ''' {token: {'id', 'symbol'}} for the tokens CoinGecko lists (unlisted ones are left out) '''
+        if self.fixture is not None:
+            coins = {key.lower(): value for key, value in self.fixture['coins'].items()}
+            return {token: coins[token.lower()] for token in tokens if token.lower() in coins}
+
+        keys = {token: f'{self.platform}:{token.lower()}' for token in tokens}
+        # older caches hold None for tokens that were unlisted then - look those up again:
+        found = {key: coin for key, coin in self._coins.get_many(keys.values()).items() if coin is not None}
+        missing = [key for key in keys.values() if key not in found and key not in self._unlisted]
+        if missing:
+            self._limiter.acquire()
+            listed = {}
+            for coin in self.cg.get_coins_list(include_platform='true'):
+                address = (coin.get('platforms') or {}).get(self.platform)
+                if address:
+                    listed[f'{self.platform}:{address.lower()}'] = {'id': coin['id'], 'symbol': coin['symbol']}
+            new = {key: listed[key] for key in missing if key in listed}
+            self._coins.put_many(new)
+            found.update(new)
+            self._unlisted.update(key for key in missing if key not in listed)
+        return {token: found[key] for token, key in keys.items() if key in found}
+
+    def get_price(self, coin_id, date_str):
+        ''' USD price of coin_id on date_str (dd-mm-YYYY, as CoinGecko wants it) '''
+        if self.fixture is not None:
+            price = self.fixture['prices'].get(coin_id, {}).get(date_str)
+        else:
+            key = f'{coin_id}:{date_str}'
+            cached = self._prices.get_many([key])
+            if key in cached:
+                price = cached[key]
+            else:
+                # coins/{id}/history is per coin, there's no bulk historical endpoint:
+                self._limiter.acquire()
+                hist_data = self.cg.get_coin_history_by_id(coin_id, date_str)
+                price = (hist_data.get('market_data') or {}).get('current_price', {}).get('usd')
+                self._prices.put(key, price)   # None (no market data that day) is remembered too
+
+        if price is None:
+            price = 1.0 if coin_id == 'real-usd' else 0.0
+        return price
+
+    def get_prices(self, tokens, time_stamp):
+        ''' DataFrame indexed by token with api_id, symbol and price as of time_stamp '''
+        date_str = dt.datetime.fromtimestamp(time_stamp, tz=dt.timezone.utc).strftime('%d-%m-%Y')
+        coins = self.resolve(tokens)
+        df = pd.DataFrame.from_dict(
+            {token: {'api_id': coin['id'], 'symbol': coin['symbol'], 'price': self.get_price(coin['id'], date_str)}
+             for token, coin in coins.items()},
+            orient='index', columns=['api_id', 'symbol', 'price'])
+        df.index.name = 'token'
+        return df
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+from common.cassette import replaying
+from common.http import get_session
+
+
+# Alchemy bills by compute units per method:
+ALCHEMY_METHOD_COSTS = {
+    'eth_chainId': 0,
+    'eth_blockNumber': 10,
+    'eth_getTransactionReceipt': 15,
+    'eth_getBlockByNumber': 16,
+    'eth_getTransactionByHash': 17,
+    'eth_call': 26,
+    'eth_getLogs': 75,
+    'eth_getBlockReceipts': 500,
+}
+ALCHEMY_DEFAULT_COST = 26
+
+# sustained budget per service, in cost units per second (requests/s for everything but Alchemy):
+BUDGETS = {
+    'alchemy': 330,
+    'etherscan': 5,
+    'covalent': 4,
+    'coingecko': 0.5,
+    'polygon-rpc': 5,
+}
+DEFAULT_BUDGET = 10
+REPLAY_BUDGET = 1e12   # replayed requests never reach the service
+
+SERVICE_HOSTS = [
+    ('alchemy.com', 'alchemy'),
+    ('etherscan.io', 'etherscan'),
+    ('arbiscan.io', 'etherscan'),
+    ('polygonscan.com', 'etherscan'),
+    ('covalenthq.com', 'covalent'),
+    ('coingecko.com', 'coingecko'),
+    ('polygon-rpc.com', 'polygon-rpc'),
+]
+
+
+class TokenBucket:
+    ''' token bucket shared by threads and asyncio tasks: each request takes `cost`
+        units and waits until the bucket has refilled enough to pay for it '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.units = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        ''' takes cost units now (going into debt if needed), returns seconds to wait '''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            wait = max(0.0, -self.tokens / self.rate)
+            self.requests += 1
+            self.units += cost
+            self.waited += wait
+            return wait
+
+    def acquire(self, cost=1):
+        wait = self.reserve(cost)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, cost=1):
+        wait = self.reserve(cost)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def service_for_url(url):
+    host = urlparse(url).hostname or url
+    for suffix, service in SERVICE_HOSTS:
+        if host.endswith(suffix):
+            return service
+    return host
+
+
+def get_limiter(service, key=None, rate=None):
+    ''' the process-wide bucket for (service, api key), created on first use '''
+    with _BUCKETS_LOCK:
+        if (service, key) not in _BUCKETS:
+            if replaying():
+                rate = REPLAY_BUDGET
+            _BUCKETS[(service, key)] = TokenBucket(rate or BUDGETS.get(service, DEFAULT_BUDGET))
+        return _BUCKETS[(service, key)]
+
+
+def limiter_for_url(url, api_key=None):
+    ''' bucket for a URL; RPC URLs carry their API key in the path, so the URL is the key '''
+    return get_limiter(service_for_url(url), api_key or url)
+
+
+def request_cost(service, method):
+    if service == 'alchemy':
+        return ALCHEMY_METHOD_COSTS.get(method, ALCHEMY_DEFAULT_COST)
+    return 1
+
+
+def rate_limit_middleware(make_request, w3):
+    ''' web3 middleware charging each JSON-RPC request to the endpoint's shared bucket '''
+    url = w3.provider.endpoint_uri
+    service = service_for_url(url)
+    limiter = limiter_for_url(url)
+
+    def middleware(method, params):
+        limiter.acquire(request_cost(service, method))
+        return make_request(method, params)
+    return middleware
+
+
+async def async_rate_limit_middleware(make_request, w3):
+    ''' AsyncWeb3 version of rate_limit_middleware '''
+    url = w3.provider.endpoint_uri
+    service = service_for_url(url)
+    limiter = limiter_for_url(url)
+
+    async def middleware(method, params):
+        await limiter.acquire_async(request_cost(service, method))
+        return await make_request(method, params)
+    return middleware
+
+
+def rate_limited_get(url, params=None, **kwargs):
+    ''' GET (on the shared session) charged to the bucket of the service behind url, keyed by the
+        API key in params (Etherscan-family 'apikey', Covalent 'key') '''
+    params = params or {}
+    limiter_for_url(url, params.get('apikey') or params.get('key') or url).acquire()
+    return get_session().get(url, params=params, **kwargs)
+
+
+def report_waits():
+    ''' one line per bucket: requests, cost units and total time spent waiting '''
+    lines = []
+    with _BUCKETS_LOCK:
+        for (service, key), bucket in _BUCKETS.items():
+            lines.append(f'{service}: {bucket.requests} requests, {bucket.units:g} units, '
+                         f'waited {bucket.waited:.1f}s (budget {bucket.rate:g}/s)')
+    return '\n'.join(lines)
@@ -0,0 +1,48 @@
+from collections import defaultdict
+
+from web3._utils.filters import construct_event_filter_params
+
+from common.decode import decode_logs
+from common.ledger import TransferLedger
+from common.log_cache import get_cached_logs
+
+
+def get_event_table(w3, event, block_num, from_block=1):
+    ''' all events of a contract event (e.g. contract.events.Staked) up to block_num, decoded '''
+    event_abi = event._get_event_abi()
+    _, event_filter_params = construct_event_filter_params(
+        event_abi,
+        w3.codec,
+        address=event.address,
+        argument_filters={'address': event.address},
+        fromBlock=from_block,
+        toBlock=block_num
+    )
+    return decode_logs(w3, event_abi, get_cached_logs(w3, event_filter_params))
+
+
+def get_stakes(w3, contract, block_num, from_block=1):
+    ''' {user: net stake} in a staking contract with Staked(user, amount) and
+        Withdrawn(user, amount) events (e.g. Convex BaseRewardPool), replayed exactly
+        up to block_num. Every stake change emits one of the two, so a user missing
+        here or at zero provably holds nothing. '''
+    stakes = defaultdict(int)
+    df_staked = get_event_table(w3, contract.events.Staked, block_num, from_block)
+    for user, amount in zip(df_staked.user, df_staked.amount):
+        stakes[user] += amount
+    df_withdrawn = get_event_table(w3, contract.events.Withdrawn, block_num, from_block)
+    for user, amount in zip(df_withdrawn.user, df_withdrawn.amount):
+        stakes[user] -= amount
+
+    negative = [user for user, stake in stakes.items() if stake < 0]
+    if negative:
+        raise ValueError(f'negative net stake for {negative[0]} in {contract.address}')
+    return dict(stakes)
+
+
+def get_token_stakes(w3, contract, block_num, from_block=1):
+    ''' {holder: balance} of a tokenized staking contract (deposits mint, withdrawals
+        burn, stakes can be transferred), replayed from its Transfer events '''
+    ledger = TransferLedger()
+    ledger.add_table(get_event_table(w3, contract.events.Transfer, block_num, from_block), amount='value')
+    return ledger.balances(block_num)
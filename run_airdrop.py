@@ -0,0 +1,103 @@
+''' runs airdrop campaigns for one snapshot date, all chains at once:
+
+        python run_airdrop.py 2023-06-01                    # every campaign
+        python run_airdrop.py 2023-06-01 chronos vechr      # just these
+
+    Campaigns run in threads of this process, so they share the rate limit buckets
+    (one budget per endpoint and API key) and the on-disk caches. On top of that
+    at most CHAIN_CONCURRENCY campaigns run per chain at a time, so the whole
+    snapshot takes about as long as the slowest chain. Each campaign's result is
+    written to <out_dir>/<campaign>.csv, request metrics of the whole run to
+    <out_dir>/rpc_metrics.json. '''
+import argparse
+import datetime as dt
+import importlib.util
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(ROOT)
+from common.metrics import dump_metrics, report_metrics
+from common.ratelimit import report_waits
+
+
+# campaign: (script, chain)
+CAMPAIGNS = {
+    'chronos': ('Chronos LPs/chronos.py', 'arbitrum'),
+    'vechr': ('veCHR minters/vechr_airdrop.py', 'arbitrum'),
+    'convex_ethereum': ('Convex Ethereum LPs/convex_ethereum.py', 'ethereum'),
+    'convex_polygon': ('Convex Polygon LPs/convex_polygon.py', 'polygon'),
+    'usdr': ('USDR minters/USDR_minting.py', 'polygon'),
+    'tangible': ('TNGBL 33/tangible_33p_airdrop.py', 'polygon'),
+    'vevelo': ('veVELO holders/velodrome_airdrop_async.py', 'optimism'),
+}
+CHAIN_CONCURRENCY = 2   # campaigns running at once on the same chain
+
+
+def load_campaign(name):
+    ''' imports a campaign script (they live in directories with spaces) '''
+    path = os.path.join(ROOT, CAMPAIGNS[name][0])
+    spec = importlib.util.spec_from_file_location(f'campaign_{name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_campaigns(snap_date, names, out_dir='.', chain_concurrency=CHAIN_CONCURRENCY):
+    ''' runs the campaigns concurrently, returns {name: seconds} of the ones that succeeded '''
+    os.makedirs(out_dir, exist_ok=True)
+    chain_slots = {chain: threading.Semaphore(chain_concurrency) for _, chain in CAMPAIGNS.values()}
+    # import up front (scripts set up their clients at import time):
+    modules = {name: load_campaign(name) for name in names}
+    start = time.monotonic()
+
+    def run_one(name):
+        chain = CAMPAIGNS[name][1]
+        with chain_slots[chain]:
+            print(f'[{time.monotonic() - start:7.1f}s] {name} ({chain}) started')
+            campaign_start = time.monotonic()
+            df = modules[name].run(snap_date)
+            df.to_csv(os.path.join(out_dir, f'{name}.csv'), index=df.index.name is not None)
+            return time.monotonic() - campaign_start
+
+    timings = {}
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = {executor.submit(run_one, name): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                timings[name] = future.result()
+                print(f'[{time.monotonic() - start:7.1f}s] {name} done in {timings[name]:.1f}s')
+            except Exception:
+                print(f'[{time.monotonic() - start:7.1f}s] {name} failed:')
+                traceback.print_exc()
+    print(f'{len(timings)} of {len(names)} campaigns done in {time.monotonic() - start:.1f}s')
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run airdrop snapshots for one date')
+    parser.add_argument('date', type=dt.date.fromisoformat, help='snapshot date, YYYY-MM-DD (midnight UTC)')
+    parser.add_argument('campaigns', nargs='*', help=f'any of {", ".join(CAMPAIGNS)} (default: all)')
+    parser.add_argument('--out-dir', default='.', help='where <campaign>.csv files are written')
+    parser.add_argument('--chain-concurrency', type=int, default=CHAIN_CONCURRENCY)
+    args = parser.parse_args()
+
+    names = args.campaigns or list(CAMPAIGNS)
+    unknown = [name for name in names if name not in CAMPAIGNS]
+    if unknown:
+        parser.error(f'unknown campaigns: {", ".join(unknown)}')
+    timings = run_campaigns(args.date, names, args.out_dir, args.chain_concurrency)
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics(os.path.join(args.out_dir, 'rpc_metrics.json'))
+    if len(timings) < len(names):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
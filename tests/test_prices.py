@@ -0,0 +1,80 @@
+''' PriceService against the checked-in price fixture, with the network switched off.
+
+    python -m pytest tests '''
+import importlib
+import json
+import os
+import sys
+
+import pytest
+from requests.adapters import HTTPAdapter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import common.cache
+import common.prices
+
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'prices.json')
+PLATFORM = 'arbitrum-one'
+WETH = '0x82aF49447D8a07e3bd95BD0d56f35241523fBab1'
+USDR = '0x40379a439D4F6795B6fc9aa5687dB461677A2dBa'
+UNLISTED = '0x000000000000000000000000000000000000dEaD'
+SNAP_TIME = 1685620800   # 2023-06-01 12:00 UTC
+
+
+class FakeCoinGecko:
+    ''' coins/list answered from the fixture's coins, counting the calls '''
+
+    def __init__(self, coins):
+        self.coins = coins
+        self.list_calls = 0
+
+    def get_coins_list(self, include_platform='false'):
+        self.list_calls += 1
+        return [dict(coin, platforms={PLATFORM: address.lower()}) for address, coin in self.coins.items()]
+
+
+@pytest.fixture(autouse=True)
+def offline(tmp_path, monkeypatch):
+    ''' fresh cache dir, and any HTTP request fails the test '''
+    monkeypatch.setattr(common.cache, 'CACHE_DIR', str(tmp_path))
+
+    def send(self, request, **kwargs):
+        raise AssertionError(f'unexpected HTTP request: {request.method} {request.url}')
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+
+
+def test_get_prices_from_fixture(monkeypatch):
+    monkeypatch.setenv('AIRDROP_PRICE_FIXTURE', FIXTURE)
+    prices = importlib.reload(common.prices)
+    service = prices.PriceService(PLATFORM)
+
+    df = service.get_prices([WETH, USDR, UNLISTED], SNAP_TIME)
+    assert sorted(df.index) == sorted([WETH, USDR])
+    assert df.loc[WETH, 'api_id'] == 'weth'
+    assert df.loc[WETH, 'price'] == 1862.35
+    assert df.loc[USDR, 'price'] == 1.0   # no price that day: USDR is pegged
+    assert service._cg is None            # CoinGecko client never created
+
+
+def test_unlisted_token_not_stored(monkeypatch):
+    monkeypatch.setattr(common.prices, 'PRICE_FIXTURE', None)
+    with open(FIXTURE) as file:
+        coins = json.load(file)['coins']
+
+    service = common.prices.PriceService(PLATFORM)
+    service._cg = FakeCoinGecko(coins)
+    assert service.resolve([WETH, UNLISTED]) == {WETH: coins[WETH]}
+    # remembered for this service, so the coins list isn't fetched again:
+    assert service.resolve([WETH, UNLISTED]) == {WETH: coins[WETH]}
+    assert service._cg.list_calls == 1
+
+    stored = common.cache.KeyValueStore('coingecko_coins').get_many(
+        [f'{PLATFORM}:{WETH.lower()}', f'{PLATFORM}:{UNLISTED.lower()}'])
+    assert stored == {f'{PLATFORM}:{WETH.lower()}': coins[WETH]}
+
+    # a later run looks the unlisted token up again:
+    service = common.prices.PriceService(PLATFORM)
+    service._cg = FakeCoinGecko(coins)
+    assert service.resolve([WETH, UNLISTED]) == {WETH: coins[WETH]}
+    assert service._cg.list_calls == 1
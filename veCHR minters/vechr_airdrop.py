@@ -1,23 +1,30 @@
 from web3 import Web3
 from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
-import json
 import datetime as dt
-import requests
 import os
+import sys
 from dotenv import load_dotenv
 import pandas as pd
-import re
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.batch_provider import BatchHTTPProvider, batch_map
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.checkpoint import ScanCheckpoint
+from common.decode import decode_logs
+from common.frames import build_frame
+from common.log_cache import get_cached_logs
+from common.metrics import dump_metrics, metrics_middleware, report_metrics
+from common.ratelimit import rate_limit_middleware, report_waits
 
 
 load_dotenv()
-ETHERSCAN_API_KEY = os.environ['ARB_ETHERSCAN_API']
 ALCHEMY_URL = os.environ['ALCHEMY_URL_ARB']
-W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL))
+W3 = Web3(BatchHTTPProvider(ALCHEMY_URL))
+W3.middleware_onion.add(metrics_middleware)   # inside the rate limiter: times requests, not waits
+W3.middleware_onion.add(rate_limit_middleware)
 FROM_BLOCK = 1
-
-# Setup
-W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL))
+SNAP_DATE = dt.date(2023, 6, 1)
+AMOUNTS_CHUNK_SIZE = 500   # tokens per checkpoint commit
 
 VECHR_ABI = [
     {
@@ -92,46 +99,23 @@ def get_all_creation_events(block_num):
     transfer_event = vechr_contract.events.Transfer
     transfer_event_abi = transfer_event._get_event_abi()
 
-    logs_all = []
-    start_block = FROM_BLOCK
-    end_block = block_num
-    while True:
-        try:
-            print(f'trying block {start_block} to {end_block}...')
-            _, event_filter_params = construct_event_filter_params(
-                transfer_event_abi,
-                W3.codec,
-                address=vechr,
-                argument_filters={'address': vechr},
-                fromBlock=start_block,
-                toBlock=end_block
-            )
-            logs = W3.eth.get_logs(event_filter_params)
-        except ValueError as e:
-            print('failed...')
-            m = re.search('range should work: \[(0x[0-9a-f]*), (0x[0-9a-f]*)\]', str(e))
-            end_block = int(m.group(2), 0)
-            continue
-        
-        logs_all.extend(logs)
-        if end_block == block_num:
-            break
-        start_block = end_block
-        end_block = block_num
-    print('done pulling logs.')
-
-    df = pd.DataFrame(columns=['hash', 'block_num'])
+    _, event_filter_params = construct_event_filter_params(
+        transfer_event_abi,
+        W3.codec,
+        address=vechr,
+        argument_filters={'address': vechr},
+        fromBlock=FROM_BLOCK,
+        toBlock=block_num
+    )
+    logs_all = get_cached_logs(W3, event_filter_params)
+
+    df_logs = decode_logs(W3, transfer_event_abi, logs_all)
     null_addr = '0x0000000000000000000000000000000000000000'
-    for log in logs_all:
-        evt = get_event_data(W3.codec, transfer_event_abi, log)
-        args = evt['args']
-        if args['from'] == null_addr:
-            token_id = args['tokenId']
-            tx_hash = evt['transactionHash'].hex()
-            evt_block_num = evt['blockNumber']
-            df.loc[token_id, 'hash'] = tx_hash
-            df.loc[token_id, 'block_num'] = evt_block_num
-    df.block_num = df.block_num.astype(int)
+    df_logs = df_logs[df_logs['from'] == null_addr]
+    token_ids = df_logs.tokenId.astype('int64').values
+    hashes = df_logs.tx_hash.values
+    block_nums = df_logs.block_num.values
+    df = build_frame(token_ids, {'hash': hashes, 'block_num': block_nums}, dtypes={'block_num': 'int64'})
     return df
 
 
@@ -145,39 +129,47 @@ def get_all_claim_events(block_num):
         fromBlock=FROM_BLOCK,
         toBlock=block_num
     )
-    logs = W3.eth.get_logs(event_filter_params)
+    logs = get_cached_logs(W3, event_filter_params)
 
-    tx_set = set()
-    for log in logs:
-        evt = get_event_data(W3.codec, AIRDROP_EVENT_ABI, log)
-        tx_set.add(evt['transactionHash'].hex())
+    tx_set = set(decode_logs(W3, AIRDROP_EVENT_ABI, logs).tx_hash)
 
     return tx_set
 
 
 def get_amounts(df_creation):
+    ''' df_creation with the owner and balance of each token at its creation block '''
     vechr = '0x9A01857f33aa382b1d5bb96C3180347862432B0d'
     vechr_contract = W3.eth.contract(vechr, abi=VECHR_ABI)
 
-    for token_id, row in df_creation.iterrows():
-        token_block_num = int(row.block_num)
+    def get_amount(token_id, token_block_num):
         owner = vechr_contract.functions.ownerOf(token_id).call(block_identifier=token_block_num)
         balance = vechr_contract.functions.balanceOfNFT(token_id).call(block_identifier=token_block_num)
-        df_creation.loc[token_id, 'owner'] = owner
-        df_creation.loc[token_id, 'balance'] = balance
-
-
-def main():
-    # get block time from etherscan API:
-    snap_time = dt.datetime(2023, 6, 1).replace(tzinfo=dt.timezone.utc).timestamp()
-    response = requests.get('https://api.arbiscan.io/api',
-                            params = {'module': 'block',
-                                      'action': 'getblocknobytime',
-                                      'timestamp': int(snap_time),
-                                      'closest': 'before',
-                                      'apikey': ETHERSCAN_API_KEY})
-    response_json = json.loads(response.content)
-    block_num = int(response_json['result'])
+        return owner, balance
+
+    # amounts are read at each token's creation block, so finished tokens stay valid
+    # across restarts and snapshots - only look up the ones we don't have yet:
+    checkpoint = ScanCheckpoint(f'vechr_amounts:{vechr}')
+    done = checkpoint.records()
+    todo = [(int(token_id), int(block_num)) for token_id, block_num in zip(df_creation.index, df_creation.block_num)
+            if str(token_id) not in done]
+    print(f'{len(todo)} token amounts left to look up')
+    for start in range(0, len(todo), AMOUNTS_CHUNK_SIZE):
+        chunk = todo[start:start + AMOUNTS_CHUNK_SIZE]
+        amounts = batch_map(lambda args: get_amount(*args), chunk)
+        checkpoint.commit(records={token_id: [owner, balance] for (token_id, _), (owner, balance) in zip(chunk, amounts)})
+
+    records = checkpoint.records()
+    amounts = [records[str(token_id)] for token_id in df_creation.index]
+    return df_creation.assign(
+        owner=[owner for owner, _ in amounts],
+        balance=pd.Series([balance for _, balance in amounts], index=df_creation.index, dtype='float64'))
+
+
+def run(snap_date):
+    ''' veCHR balance per owner of the non-airdrop locks as of snap_date '''
+    # get snapshot block from the node:
+    snap_time = date_to_timestamp(snap_date)
+    block_num = get_block_by_timestamp(W3, snap_time)
 
     # get (non-airdrop) veCHR creation events:
     df_creation = get_all_creation_events(block_num)
@@ -185,5 +177,16 @@ def main():
     df_creation = df_creation[~df_creation.hash.isin(airdropped_tx)]
 
     # enrich with amount:
-    get_amounts(df_creation)
-    df_creation.groupby('owner')[['balance']].sum().to_clipboard()
+    df_creation = get_amounts(df_creation)
+    return df_creation.groupby('owner')[['balance']].sum()
+
+
+def main():
+    run(SNAP_DATE).to_clipboard()
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('vechr_metrics.json')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,32 @@
-from web3 import AsyncWeb3, AsyncHTTPProvider
-import json
+from web3 import AsyncWeb3, AsyncHTTPProvider, Web3
 import datetime as dt
-import requests
 from collections import defaultdict
 import asyncio
 import pandas as pd
 from dotenv import load_dotenv
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.aimd import AIMDPool
+from common.blocks import date_to_timestamp, get_block_by_timestamp
+from common.cassette import async_cassette_middleware
+from common.checkpoint import ScanCheckpoint
+from common.http import get_session, make_async_session
+from common.metrics import async_metrics_middleware, dump_metrics, metrics_middleware, report_metrics
+from common.ratelimit import async_rate_limit_middleware, rate_limit_middleware, report_waits
 
 load_dotenv()
-ETHERSCAN_API_KEY = os.environ['OPT_ETHERSCAN_API']
 ALCHEMY_URL = os.environ['ALCHEMY_URL_OPT']
 
-global_lock = asyncio.Lock()
 w3 = AsyncWeb3(AsyncHTTPProvider(ALCHEMY_URL))
+w3.middleware_onion.add(async_metrics_middleware)   # inside the rate limiter: times requests, not waits
+w3.middleware_onion.add(async_rate_limit_middleware)
+w3.middleware_onion.add(async_cassette_middleware)   # outermost: a replay skips the limiter too
+# sync client for the one-off snapshot block lookup:
+SYNC_W3 = Web3(Web3.HTTPProvider(ALCHEMY_URL, session=get_session()))
+SYNC_W3.middleware_onion.add(metrics_middleware)
+SYNC_W3.middleware_onion.add(rate_limit_middleware)
 
 # Voting Escrow contract:
 abi = [
@@ -52,60 +65,72 @@ venft = '0x9c7305eb78a432ced5C4D14Cac27E8Ed569A2e26'
 venft_contract = w3.eth.contract(venft, abi=abi)
 
 max_token_id = 26500
-token_id_generator = (x for x in range(max_token_id))
-snap_time = dt.datetime(2023, 6, 1).replace(tzinfo=dt.timezone.utc).timestamp()
-
-# get block time from etherscan API:
-response = requests.get('https://api-optimistic.etherscan.io/api',
-                        params = {'module': 'block',
-                                  'action': 'getblocknobytime',
-                                  'timestamp': int(snap_time),
-                                  'closest': 'before',
-                                  'apikey': ETHERSCAN_API_KEY})
-response_json = json.loads(response.content)
-block_num = int(response_json['result'])
+chunk_size = 25   # token ids per work item
+max_concurrency = 64   # max chunks in flight (and pooled connections)
+SNAP_DATE = dt.date(2023, 6, 1)
 
 null_addr = '0x0000000000000000000000000000000000000000'
-voter_balances = defaultdict(int)
-
-
-async def get_voter_balance(thread_id):
-    while True:
-        async with global_lock:
-            try:
-                token_id = next(token_id_generator)
-            except:
-                return
-
-        while True:
-            try:
-                print(f'token_id {token_id} thread {thread_id}')
-                voter_address = await venft_contract.functions.ownerOf(token_id).call(block_identifier=block_num)
-                if voter_address == null_addr:
-                    voter_vevelo = 0
-                else:
-                    voter_vevelo = await venft_contract.functions.balanceOfAtNFT(token_id, block_num).call()
-                break
-            except Exception as e:
-                print(f'exception: {e}')
-                asyncio.sleep(1)
-
-        async with global_lock:
-            voter_balances[voter_address] += voter_vevelo
-
-
-async def main():
-    task_list = []
-    for thread_id in range(6):
-        task_list.append(asyncio.create_task(get_voter_balance(thread_id)))
-    for task in task_list:
-        await task
+
+
+async def get_voter_balances(token_ids, block_num):
+    ''' veVELO balance per owner for a range of token ids '''
+    voter_balances = defaultdict(int)
+    for token_id in token_ids:
+        voter_address = await venft_contract.functions.ownerOf(token_id).call(block_identifier=block_num)
+        if voter_address == null_addr:
+            voter_vevelo = 0
+        else:
+            voter_vevelo = await venft_contract.functions.balanceOfAtNFT(token_id, block_num).call()
+        voter_balances[voter_address] += voter_vevelo
+    return voter_balances
+
+
+async def scan(block_num):
+    ''' voting power per owner over all token ids at block_num '''
+    # skip token ids covered by ranges an earlier run (with any chunking) finished for this block:
+    checkpoint = ScanCheckpoint(f'vevelo:{venft}:{block_num}')
+    chunks = [range(start, min(start + chunk_size, end + 1))
+              for first, end in checkpoint.missing_ranges(0, max_token_id - 1)
+              for start in range(first, end + 1, chunk_size)]
+    print(f'{len(chunks)} token id ranges left to scan')
+
+    # commit each range together with its balances as soon as it finishes:
+    def save(chunk, chunk_balances):
+        checkpoint.commit(done=(chunk.start, chunk.stop - 1), totals=chunk_balances)
+
+    async def worker(token_ids):
+        return await get_voter_balances(token_ids, block_num)
+
+    # pooled keep-alive connections for the scan (the session belongs to this event loop):
+    session = make_async_session(limit=max_concurrency)
+    await w3.provider.cache_async_session(session)
+    pool = AIMDPool(maximum=max_concurrency)
+    try:
+        await pool.run(worker, chunks, on_result=save)
+    finally:
+        await session.close()
+    voter_balances = checkpoint.totals()
 
     df = pd.DataFrame.from_dict(voter_balances, orient='index', columns=['voting_power'])
     df.sort_values('voting_power', ascending=False)
     df.index.name = 'address'
-    df.to_csv('velodrome_voters.csv')
+    return df
+
+
+def run(snap_date):
+    ''' veVELO voting power per address as of snap_date '''
+    # get snapshot block from the node:
+    block_num = get_block_by_timestamp(SYNC_W3, date_to_timestamp(snap_date))
+    return asyncio.run(scan(block_num))
+
+
+def main():
+    run(SNAP_DATE).to_csv('velodrome_voters.csv')
     print('file written.')
+    print(report_waits())
+    print(report_metrics())
+    dump_metrics('velodrome_metrics.json')
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    main()